@@ -0,0 +1,59 @@
+"""
+Timing and output check of two implementations of a parse_reports step on the same reports, shared by
+hierarchy_fill.py and text_cleaning.py.
+* an engine is called as engine(key, df) for every (key, df) of the reports, with a copy of df
+* outputs are compared as csv, None (a report that was skipped) only matches None
+"""
+
+import sys
+import time
+
+
+def time_engine(engine, reports, repeat):
+    # best time of repeat runs over all the reports, and the outputs of the last run
+    best = None
+    outputs = []
+    for _ in range(repeat):
+        outputs = []
+        start = time.perf_counter()
+        for key, df in reports:
+            outputs.append(engine(key, df.copy()))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, outputs
+
+
+def same_output(expected, actual):
+    if expected is None or actual is None:
+        return expected is None and actual is None
+    return expected.to_csv(index=False) == actual.to_csv(index=False)
+
+
+def compare(reports, baseline, candidate, repeat):
+    """
+    Times baseline and candidate, (name, engine) pairs, prints their times and the speedup.
+    Exits with 1 if the output of the candidate differs from the baseline for any report.
+    """
+    baseline_name, baseline_engine = baseline
+    candidate_name, candidate_engine = candidate
+    baseline_time, expected = time_engine(baseline_engine, reports, repeat)
+    candidate_time, actual = time_engine(candidate_engine, reports, repeat)
+    mismatches = [
+        key
+        for (key, _), e, a in zip(reports, expected, actual)
+        if not same_output(e, a)
+    ]
+
+    width = max(len(baseline_name), len(candidate_name), len("speedup")) + 1
+    for name, elapsed in [
+        (baseline_name, baseline_time),
+        (candidate_name, candidate_time),
+    ]:
+        print(
+            f"{name + ':':<{width}} {elapsed:.3f}s ({elapsed / len(reports) * 1000:.2f} ms/report)"
+        )
+    print(f"{'speedup:':<{width}} {baseline_time / candidate_time:.1f}x")
+    if mismatches:
+        print(f"Output differs for {len(mismatches)} reports: {mismatches}")
+        sys.exit(1)
+    print("Output is identical for all reports")
@@ -0,0 +1,62 @@
+"""
+Compare add_additional_columns (column wise) with add_additional_columns_iterrows (row by row)
+on real reports from the yearly zips. Run from the repo root:
+
+    python benchmarks/hierarchy_fill.py --limit 50
+"""
+
+import argparse
+import sys
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import parse_reports as pr  # noqa: E402
+from engine_comparison import compare  # noqa: E402
+
+
+def load_reports(zip_paths, limit):
+    # cleaned report frames, ready for add_additional_columns
+    reports = []
+    for zip_path in zip_paths:
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            members = [m for m in zip_ref.namelist() if m.endswith(".xls")]
+            for member in members:
+                if len(reports) >= limit:
+                    return reports
+                date = pr.date_from_report_name(Path(member))
+                df = pr.read_excel_bytes(zip_ref.read(member))
+                df = pr.get_clean_df(df, "xls", date)
+                if df is None:
+                    continue
+                df.columns = range(len(df.columns))
+                reports.append((member, df))
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--src-dir", type=Path, default=pr.src_dir)
+    parser.add_argument("--limit", type=int, default=100, help="number of reports")
+    parser.add_argument("--repeat", type=int, default=3, help="best of n runs")
+    args = parser.parse_args()
+
+    zip_paths = sorted(args.src_dir.glob("*.zip"), reverse=True)
+    reports = load_reports(zip_paths, args.limit)
+    if not reports:
+        print(f"No xls reports found in {args.src_dir}")
+        return
+    rows = sum(len(df) for _, df in reports)
+    print(f"{len(reports)} reports, {rows} rows")
+
+    compare(
+        reports,
+        ("iterrows", lambda member, df: pr.add_additional_columns_iterrows(df)),
+        ("vectorized", lambda member, df: pr.add_additional_columns(df)),
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
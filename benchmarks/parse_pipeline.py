@@ -0,0 +1,319 @@
+"""
+Benchmark the stages of the NPP parse pipeline on synthetic reports, runs offline. Run from the repo root:
+
+    python benchmarks/parse_pipeline.py --count 30 --stations 3
+    python benchmarks/parse_pipeline.py --compare benchmarks/results/<earlier run>.json
+
+* reports are generated in both layouts (TYPE and SECTOR in separate columns, or merged) as xls and/or csv files
+* xls reports go through both pipelines of parse_reports: zip (the default, read from the yearly zip and decoded
+  by read_excel_bytes) and csv-cache (--csv-cache, convert_report_to_csv and read_csv). csv files are already
+  converted, only csv-cache applies
+* each stage is timed per report, write_to_csv once for all the reports of a case
+* per report latency percentiles and the peak RSS of the process are saved as JSON
+"""
+
+import argparse
+import json
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import parse_reports as pr  # noqa: E402
+import synthetic_reports  # noqa: E402
+
+results_dir = Path(__file__).parent / "results"
+pipelines = ["zip", "csv-cache"]
+report_stages = [
+    "read_zip_member",
+    "read_excel_bytes",
+    "convert_report_to_csv",
+    "read_csv",
+    "clean_report",
+    "add_additional_columns",
+]
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in KB on linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def get_latency_stats(seconds):
+    ms = np.array(seconds) * 1000
+    return {
+        "total_s": round(float(ms.sum()) / 1000, 4),
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def parse_zip_member(zip_ref: zipfile.ZipFile, member):
+    # same steps as parse_reports.get_zip_member_df, with the time of each stage
+    timings = {}
+    date = pr.date_from_report_name(Path(member))
+
+    start = time.perf_counter()
+    data = zip_ref.read(member)
+    timings["read_zip_member"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df = pr.read_excel_bytes(data)
+    timings["read_excel_bytes"] = time.perf_counter() - start
+    return clean_and_transform(df, date, timings)
+
+
+def parse_report(report_path: Path, format):
+    # same steps as parse_reports.get_trnsformed_df, with the time of each stage
+    timings = {}
+    date = pr.date_from_report_name(report_path)
+
+    start = time.perf_counter()
+    if format == "xls":
+        csv_path = pr.convert_report_to_csv(report_path)
+        timings["convert_report_to_csv"] = time.perf_counter() - start
+    else:
+        # csv fixtures are already converted
+        csv_path = report_path
+
+    start = time.perf_counter()
+    df = pd.read_csv(csv_path, header=None)
+    timings["read_csv"] = time.perf_counter() - start
+    return clean_and_transform(df, date, timings)
+
+
+def clean_and_transform(df, date, timings):
+    start = time.perf_counter()
+    df = pr.get_clean_df(df, "xls", date)
+    timings["clean_report"] = time.perf_counter() - start
+    if df is None:
+        return None, timings
+
+    start = time.perf_counter()
+    df.columns = range(len(df.columns))
+    df = pr.add_additional_columns(df)
+    timings["add_additional_columns"] = time.perf_counter() - start
+    return df, timings
+
+
+def parse_reports(case_dir: Path, report_paths, format, pipeline):
+    # (report name, df, timings) of every report, in the order of report_paths
+    if pipeline == "csv-cache":
+        for report_path in report_paths:
+            yield report_path.name, *parse_report(report_path, format)
+        return
+    # the reports are zipped like the yearly zips of data/npp, the zip is opened once like in parse_reports
+    zip_path = case_dir / "reports.zip"
+    with zipfile.ZipFile(zip_path, "w") as zip_ref:
+        for report_path in report_paths:
+            zip_ref.write(report_path, report_path.name)
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        for report_path in report_paths:
+            yield report_path.name, *parse_zip_member(zip_ref, report_path.name)
+
+
+def run_case(work_dir: Path, format, layout, pipeline, count, stations, seed):
+    case_dir = work_dir / f"{format}-{layout}-{pipeline}"
+    report_paths = synthetic_reports.write_reports(
+        case_dir / "reports", count, format, layout, stations, seed
+    )
+    # converted csv files go to the case directory, not to the data directory
+    pr.output_dir = case_dir / "converted"
+
+    stage_times = {stage: [] for stage in report_stages}
+    report_times = []
+    dfs = []
+    failed = []
+    for name, df, timings in parse_reports(case_dir, report_paths, format, pipeline):
+        for stage, seconds in timings.items():
+            stage_times[stage].append(seconds)
+        report_times.append(sum(timings.values()))
+        if df is None:
+            failed.append(name)
+        else:
+            dfs.append(df)
+
+    all_df = pd.concat(dfs, ignore_index=True)
+    tables_dir = case_dir / "tables"
+    tables_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    pr.write_to_csv(all_df, tables_dir)
+    write_time = time.perf_counter() - start
+
+    return {
+        "format": format,
+        "layout": layout,
+        "pipeline": pipeline,
+        "reports": len(report_paths),
+        "failed": failed,
+        "rows_parsed": int(all_df[pr.row_type_col].notna().sum()),
+        "stages": {
+            stage: get_latency_stats(times)
+            for stage, times in stage_times.items()
+            if len(times) > 0
+        },
+        "report": get_latency_stats(report_times),
+        "write_to_csv": {"total_s": round(write_time, 4)},
+        "peak_rss_mb": round(get_peak_rss_mb(), 1),
+    }
+
+
+def print_case(case):
+    print(
+        f"\n{case['format']} / {case['layout']} / {case['pipeline']}: {case['reports']} reports"
+        f", {case['rows_parsed']} rows"
+        f", peak RSS {case['peak_rss_mb']} MB"
+    )
+    if case["failed"]:
+        print(f"  failed to parse: {case['failed']}")
+    for stage, stats in [*case["stages"].items(), ("per report", case["report"])]:
+        print(
+            f"  {stage:<24} p50 {stats['p50_ms']:>8.2f} ms  p90 {stats['p90_ms']:>8.2f} ms"
+            f"  p99 {stats['p99_ms']:>8.2f} ms  total {stats['total_s']:.3f}s"
+        )
+    print(f"  {'write_to_csv':<24} total {case['write_to_csv']['total_s']:.3f}s")
+
+
+def compare(previous_path: Path, results):
+    # p50 of every stage of this run relative to an earlier run, > 1 is slower
+    with open(previous_path, "r") as file:
+        previous = json.load(file)
+    # results from before the zip pipeline was benchmarked only have csv-cache cases
+    previous_cases = {
+        (c["format"], c["layout"], c.get("pipeline", "csv-cache")): c
+        for c in previous["cases"]
+    }
+    print(f"\nCompared to {previous_path} ({previous['created']})")
+    for case in results["cases"]:
+        old_case = previous_cases.get(
+            (case["format"], case["layout"], case["pipeline"])
+        )
+        if old_case is None:
+            continue
+        old_stages = {**old_case["stages"], "per report": old_case["report"]}
+        for stage, stats in [*case["stages"].items(), ("per report", case["report"])]:
+            old_stats = old_stages.get(stage)
+            if not old_stats or old_stats["p50_ms"] == 0:
+                continue
+            ratio = stats["p50_ms"] / old_stats["p50_ms"]
+            print(
+                f"  {case['format']} / {case['layout']} / {case['pipeline']} {stage:<24} p50 {old_stats['p50_ms']:.2f} -> "
+                f"{stats['p50_ms']:.2f} ms ({ratio:.2f}x)"
+            )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=30, help="reports per case")
+    parser.add_argument(
+        "--stations",
+        type=int,
+        default=3,
+        help="stations per sector and type, sets the size of a report",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["xls", "csv"],
+        action="append",
+        help="report formats, can be repeated. Defaults to both, xls needs xlwt",
+    )
+    parser.add_argument(
+        "--layout",
+        choices=synthetic_reports.layouts,
+        action="append",
+        help="report layouts, can be repeated. Defaults to both",
+    )
+    parser.add_argument(
+        "--pipeline",
+        choices=pipelines,
+        action="append",
+        help="parse pipelines, can be repeated. Defaults to both, zip only applies to xls reports",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=None,
+        help="results file, defaults to benchmarks/results/parse_pipeline-<time>.json",
+    )
+    parser.add_argument(
+        "--compare", type=Path, default=None, help="results file of an earlier run"
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the generated reports and outputs"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    formats = args.format or ["xls", "csv"]
+    layouts = args.layout or synthetic_reports.layouts
+    selected_pipelines = args.pipeline or pipelines
+    work_dir = Path(tempfile.mkdtemp(prefix="npp-bench-"))
+    created = datetime.now()
+    results = {
+        "created": created.isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "params": {
+            "count": args.count,
+            "stations": args.stations,
+            "seed": args.seed,
+            "formats": formats,
+            "layouts": layouts,
+            "pipelines": selected_pipelines,
+        },
+        "cases": [],
+    }
+    try:
+        for format in formats:
+            for layout in layouts:
+                for pipeline in selected_pipelines:
+                    if pipeline == "zip" and format != "xls":
+                        continue
+                    case = run_case(
+                        work_dir,
+                        format,
+                        layout,
+                        pipeline,
+                        args.count,
+                        args.stations,
+                        args.seed,
+                    )
+                    print_case(case)
+                    results["cases"].append(case)
+    finally:
+        if args.keep:
+            print(f"\nReports and outputs are in {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output_path = args.output or (
+        results_dir / f"parse_pipeline-{created.strftime('%Y%m%d-%H%M%S')}.json"
+    )
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as file:
+        json.dump(results, file, indent=4)
+    print(f"\nResults saved to {output_path}")
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Synthetic daily generation reports (DGR) with the structure of the NPP xls reports, for benchmarks that run offline.
+Two layouts:
+* separate: TYPE and SECTOR in their own columns, 15 columns (17 after the date and format columns are added)
+* merged: TYPE and SECTOR share a column, 14 columns, as in some of the later reports
+Writing xls files needs xlwt (pip install xlwt), csv files are written like convert_excel_to_csv would.
+"""
+
+import csv
+import random
+from datetime import date, timedelta
+from pathlib import Path
+
+layouts = ["separate", "merged"]
+regions = {
+    "NORTHERN": ["DELHI", "HARYANA", "PUNJAB", "RAJASTHAN", "UTTAR PRADESH"],
+    "WESTERN": ["CHHATTISGARH", "GUJARAT", "MADHYA PRADESH", "MAHARASHTRA"],
+    "SOUTHERN": ["ANDHRA PRADESH", "KARNATAKA", "TAMIL NADU", "TELANGANA"],
+    "EASTERN": ["BIHAR", "JHARKHAND", "ODISHA", "WEST BENGAL"],
+    "NORTH EASTERN": ["ASSAM", "MEGHALAYA", "TRIPURA"],
+}
+sectors = ["CENTRAL", "STATE", "PVT"]
+station_types = {
+    "THERMAL": ["TPS", "STPS", "SUPER TPS"],
+    "HYDRO": ["HPS", "HEP"],
+    "NUCLEAR": ["A.P.S.", "NPP"],
+}
+station_names = [
+    "DADRI", "RIHAND", "SINGRAULI", "KORBA", "SIPAT", "VINDHYACHAL", "TALCHER", "FARAKKA",
+    "RAMAGUNDAM", "MUNDRA", "TIRORA", "CHANDRAPUR", "KOTA", "PANIPAT", "BAKRESWAR", "NEYVELI",
+]  # fmt: skip
+unit_capacities = [110, 210, 250, 500, 600, 660, 800]
+outage_types = ["FO", "PO", "SO"]
+outage_remarks = [
+    "BOILER TUBE LEAKAGE",
+    "ANNUAL OVERHAUL",
+    "COAL SHORTAGE",
+    "RESERVE SHUTDOWN",
+    "TURBINE VIBRATION HIGH",
+]
+header_rows = [
+    ["OPERATION PERFORMANCE MONITORING DIVISION"],
+    ["REGION WISE DAILY GENERATION REPORT"],
+]
+value_columns = [
+    "MONITORED CAPACITY (MW)",
+    "TODAY'S PROGRAM (MU)",
+    "TODAY'S ACTUAL (MU)",
+    "FY YTD PROGRAM (MU)",
+    "FY YTD ACTUAL (MU)",
+    "COAL STOCK (DAYS)",
+    "CAP UNDER OUTAGE (MW)",
+    "OUTAGE DATE",
+    "EXPECTED DATE / SYNC DATE",
+    "REMARKS",
+]
+
+
+def get_column_header(layout):
+    if layout == "merged":
+        return [
+            "POWER STATION",
+            "UNIT NO",
+            "TYPE / SECTOR",
+            "OUTAGE TYPE",
+        ] + value_columns
+    return ["POWER STATION", "UNIT NO", "TYPE", "SECTOR", "OUTAGE TYPE"] + value_columns
+
+
+def get_values(rng, capacity, outage=None, report_date=None):
+    # generation is in MU, a day at full capacity is capacity * 24 / 1000
+    full_day = capacity * 24 / 1000
+    program = round(full_day * rng.uniform(0.5, 0.9), 2)
+    actual = round(program * rng.uniform(0.0 if outage else 0.7, 1.1), 2)
+    days = rng.randint(1, 365)
+    values = [
+        capacity,
+        program,
+        actual,
+        round(program * days, 2),
+        round(actual * days, 2),
+        round(rng.uniform(0, 30), 1) if rng.random() < 0.6 else "",
+        capacity if outage else "",
+    ]
+    if outage:
+        outage_date = report_date - timedelta(days=rng.randint(0, 60))
+        expected_date = report_date + timedelta(days=rng.randint(1, 60))
+        values += [
+            outage_date.strftime("%d-%b-%Y"),
+            expected_date.strftime("%d-%b-%Y") if rng.random() < 0.7 else "",
+            rng.choice(outage_remarks),
+        ]
+    else:
+        values += ["", "", ""]
+    return values
+
+
+def get_row(layout, name, unit_no="", type="", sector="", outage="", values=None):
+    values = values if values is not None else [""] * len(value_columns)
+    if layout == "merged":
+        return [name, unit_no, type or sector, outage] + values
+    return [name, unit_no, type, sector, outage] + values
+
+
+def get_station_rows(rng, layout, name, report_date):
+    rows = []
+    units = []
+    for unit_no in range(1, rng.randint(1, 6) + 1):
+        capacity = rng.choice(unit_capacities)
+        outage = rng.choice(outage_types) if rng.random() < 0.15 else ""
+        units.append(
+            get_row(
+                layout,
+                "Unit",
+                unit_no,
+                outage=outage,
+                values=get_values(rng, capacity, outage, report_date),
+            )
+        )
+    capacity = sum(unit[-10] for unit in units)
+    rows.append(get_row(layout, name, values=get_values(rng, capacity)))
+    return rows + units
+
+
+def generate_report(report_date: date, layout="separate", stations=3, seed=0):
+    """
+    Rows of one report: title and column header rows, then for every region and state the total rows
+    followed by SECTOR:, TYPE:, station and unit rows. The column header repeats every 50 rows like the
+    page headers of the real reports. stations is the number of stations per sector and type.
+    """
+    assert layout in layouts, f"Unknown layout: {layout}"
+    rng = random.Random(f"{seed}-{layout}-{report_date}")
+    column_header = get_column_header(layout)
+    body = []
+    for region, states in regions.items():
+        body.append([region])
+        body.append(get_row(layout, "REGION TOTAL", values=get_values(rng, 50000)))
+        for state in states:
+            body.append([state])
+            body.append(get_row(layout, "STATE TOTAL", values=get_values(rng, 10000)))
+            for sector in rng.sample(sectors, rng.randint(1, len(sectors))):
+                body.append(get_row(layout, "SECTOR:", sector=sector))
+                for type, suffixes in station_types.items():
+                    if type != "THERMAL" and rng.random() < 0.5:
+                        continue
+                    body.append(get_row(layout, "TYPE:", type=type))
+                    for _ in range(stations):
+                        name = f"{rng.choice(station_names)} {rng.choice(suffixes)}"
+                        if rng.random() < 0.3:
+                            name += f" STAGE-{rng.choice(['I', 'II', 'III'])}"
+                        body += get_station_rows(rng, layout, name, report_date)
+
+    rows = [*header_rows, column_header]
+    for i, row in enumerate(body):
+        if i > 0 and i % 50 == 0:
+            rows.append(column_header)
+        rows.append(row)
+    return rows
+
+
+def write_xls(rows, path: Path):
+    import xlwt  # only needed to write xls fixtures
+
+    workbook = xlwt.Workbook()
+    sheet = workbook.add_sheet("DGR")
+    for i, row in enumerate(rows):
+        for j, value in enumerate(row):
+            if value != "":
+                sheet.write(i, j, value)
+    workbook.save(str(path))
+    return path
+
+
+def write_csv(rows, path: Path):
+    # laid out like the csv of convert_excel_to_csv, first row as the header and empty header cells named "Unnamed: n"
+    width = max(len(row) for row in rows)
+    header = rows[0] + [""] * (width - len(rows[0]))
+    header = [
+        value if value != "" else f"Unnamed: {i}" for i, value in enumerate(header)
+    ]
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for row in rows[1:]:
+            row = row + [""] * (width - len(row))
+            writer.writerow(row)
+    return path
+
+
+def write_reports(
+    output_dir: Path, count, format="xls", layout="separate", stations=3, seed=0
+):
+    """
+    Write count reports for consecutive dates, named like the downloaded reports (dgr2-YYYY-MM-DD.xls).
+    Returns the paths of the reports.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    start_date = date(2023, 4, 1)
+    writer = write_xls if format == "xls" else write_csv
+    paths = []
+    for i in range(count):
+        report_date = start_date + timedelta(days=i)
+        rows = generate_report(report_date, layout, stations, seed)
+        path = output_dir / f"dgr2-{report_date.isoformat()}.{format}"
+        paths.append(writer(rows, path))
+    return paths
@@ -0,0 +1,60 @@
+"""
+Compare clean_rows (single pass over the text cells) with clean_rows_legacy (clean_df and
+drop_unnecessary_rows) on a year of reports from the yearly zips. Run from the repo root:
+
+    python benchmarks/text_cleaning.py --year 2023
+"""
+
+import argparse
+import sys
+import zipfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import parse_reports as pr  # noqa: E402
+from engine_comparison import compare  # noqa: E402
+
+
+def load_reports(zip_path, limit):
+    # raw report frames, as read from the xls files
+    reports = []
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        members = sorted(m for m in zip_ref.namelist() if m.endswith(".xls"))
+        for member in members[:limit]:
+            date = pr.date_from_report_name(Path(member))
+            reports.append((date, pr.read_excel_bytes(zip_ref.read(member))))
+    return reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--src-dir", type=Path, default=pr.src_dir)
+    parser.add_argument("--year", default=None, help="defaults to the latest year")
+    parser.add_argument("--limit", type=int, default=None, help="number of reports")
+    parser.add_argument("--repeat", type=int, default=3, help="best of n runs")
+    args = parser.parse_args()
+
+    zip_paths = sorted(args.src_dir.glob("*.zip"))
+    if args.year:
+        zip_paths = [path for path in zip_paths if path.stem == args.year]
+    if not zip_paths:
+        print(f"No yearly zip found in {args.src_dir}")
+        return
+    reports = load_reports(zip_paths[-1], args.limit)
+    if not reports:
+        print(f"No xls reports found in {zip_paths[-1]}")
+        return
+    rows = sum(len(df) for _, df in reports)
+    print(f"{zip_paths[-1].name}: {len(reports)} reports, {rows} rows")
+
+    compare(
+        reports,
+        ("legacy", lambda date, df: pr.clean_rows_legacy(df, date)),
+        ("fused", lambda date, df: pr.clean_rows(df, date)),
+        args.repeat,
+    )
+
+
+if __name__ == "__main__":
+    main()
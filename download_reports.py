@@ -1,36 +1,61 @@
+import argparse
+import concurrent.futures
+import threading
+import time
 import pytz
 from datetime import datetime, timedelta
 from pathlib import Path
+from urllib.parse import urlparse
 import requests
 import json
 import zipfile
 
+from src.meritindia.tracking_store import TrackingStore
+from src.meritindia import metrics
+
 temp_output_dir = Path("./data/npp/daily-generation/raw/")
 processed_output_dir = Path("./data/npp/daily-generation/csv/")
 zip_dir = Path("./data/npp/daily-generation/raw/")
 track_json_path = Path("./data/npp/daily-generation/track.json")
+metrics_dir = Path("./data/metrics/")
 timezone = pytz.timezone("Asia/Kolkata")
 start_date = datetime(2017, 9, 1).replace(tzinfo=timezone)
+request_timeout = 60
+max_retry_age_days = 30
+# retries of failed dates back off exponentially from base_delay, per kind of failure
+retry_policies = {
+    "not_found": {"base_delay": timedelta(days=1), "max_attempts": 4},
+    "client_error": {"base_delay": timedelta(days=1), "max_attempts": 3},
+    "server_error": {"base_delay": timedelta(hours=6), "max_attempts": 8},
+    "timeout": {"base_delay": timedelta(hours=1), "max_attempts": 8},
+}
+track_store = None
 track_json = None
-existing_reports = None
+# files in each yearly zip, loaded only for the years of the dates being planned
+existing_reports = {}
 
 
 def bootstrap():
     temp_output_dir.mkdir(parents=True, exist_ok=True)
+    global track_store
     global track_json
     global existing_reports
-    if not track_json_path.exists():
-        track_json = {"failed": {}}
-        write_json(track_json, track_json_path)
-    else:
-        with open(track_json_path, "r") as file:
-            track_json = json.load(file)
+    track_store = TrackingStore(track_json_path, default={"failed": {}})
+    # read only view, changes go through track_store
+    track_json = track_store.data
+
+    existing_reports = {}
+
 
-    existing_reports = get_all_reports()
+def record_response(response):
+    metrics.incr(f"http_status.{response.status_code}")
+    metrics.incr("bytes_fetched", len(response.content))
 
 
 def download_file(url, output_path: Path):
-    response = requests.get(url)
+    with metrics.timer("http_latency_s"):
+        response = requests.get(url, timeout=request_timeout)
+    record_response(response)
     response.raise_for_status()
     output_path.parent.mkdir(parents=True, exist_ok=True)
     with open(output_path, "wb") as file:
@@ -50,18 +75,48 @@ def get_failed_dates_map():
 
 
 def flush_track_json():
-    write_json(track_json, track_json_path)
+    track_store.flush()
+
+
+def get_status_class(response_code) -> str:
+    if response_code is None:
+        return "timeout"
+    if response_code in (404, 410):
+        return "not_found"
+    if response_code >= 500:
+        return "server_error"
+    return "client_error"
+
+
+def record_failure(date_str, url, response_code):
+    # response_code is None when the request timed out or the connection failed
+    previous = track_json["failed"].get(date_str, {})
+    metrics.incr(f"failures.{get_status_class(response_code)}")
+    track_store.set(
+        ["failed", date_str],
+        {
+            "url": url,
+            "response_code": response_code,
+            "status_class": get_status_class(response_code),
+            "attempts": previous.get("attempts", 1 if previous else 0) + 1,
+            "last_attempt": ist_now().strftime("%Y-%m-%d %H:%M:%S"),
+        },
+    )
+
+
+def clear_failure(date_str):
+    track_store.delete(["failed", date_str])
 
 
 def update_latest_downloaded_date(date):
     # update if the date is greater than the current latest downloaded date
     date_str = date.strftime("%Y-%m-%d")
     if "lastest_downloaded_date" not in track_json:
-        track_json["latest_downloaded_date"] = date_str
+        track_store.set(["latest_downloaded_date"], date_str)
 
     current_date = ist_parse(track_json["latest_downloaded_date"])
     if date > current_date:
-        track_json["latest_downloaded_date"] = date_str
+        track_store.set(["latest_downloaded_date"], date_str)
 
 
 def write_json(data, dest_path):
@@ -77,6 +132,42 @@ def ist_parse(date_str):
     return datetime.strptime(date_str, "%Y-%m-%d").replace(tzinfo=timezone)
 
 
+def get_retry_time(failure: dict):
+    """
+    When a failed date is due for another attempt, None if it should not be retried anymore.
+    Delay doubles with every attempt, starting from the base delay of the kind of failure.
+    Entries from before attempts were tracked count as one attempt and are due right away.
+    """
+    status_class = failure.get(
+        "status_class", get_status_class(failure.get("response_code"))
+    )
+    policy = retry_policies[status_class]
+    attempts = failure.get("attempts", 1)
+    if attempts >= policy["max_attempts"]:
+        return None
+    if "last_attempt" not in failure:
+        return ist_now()
+    last_attempt = datetime.strptime(
+        failure["last_attempt"], "%Y-%m-%d %H:%M:%S"
+    ).replace(tzinfo=timezone)
+    return last_attempt + policy["base_delay"] * 2 ** (attempts - 1)
+
+
+def get_dates_to_retry():
+    # failed dates due for another attempt, retires the ones past the retry limits
+    dates_to_retry = []
+    for date_str, failure in list(track_json["failed"].items()):
+        if failure.get("retired"):
+            continue
+        date = ist_parse(date_str)
+        retry_time = get_retry_time(failure)
+        if (ist_now() - date).days >= max_retry_age_days or retry_time is None:
+            track_store.set(["failed", date_str, "retired"], True)
+        elif retry_time <= ist_now():
+            dates_to_retry.append(date)
+    return dates_to_retry
+
+
 def get_dates_to_download():
     latest_downloaded_date = track_json.get("latest_downloaded_date", None)
     end_date = ist_now() - timedelta(days=2)
@@ -84,27 +175,61 @@ def get_dates_to_download():
         start_with = start_date
     else:
         start_with = ist_parse(latest_downloaded_date) + timedelta(days=1)
-    dates_to_retry = []
-    for date_str, date_info in track_json["failed"].items():
-        date = ist_parse(date_str)
-        if (ist_now() - date).days < 30:
-            dates_to_retry.append(date)
+    dates_to_retry = get_dates_to_retry()
+    metrics.incr("retries", len(dates_to_retry))
+    # failed dates which are not due yet or retired are left to the scheduler
+    failed_dates = set(track_json["failed"])
 
     dates = []
     for day in range((end_date - start_with).days + 1):
         date = start_with + timedelta(days=day)
-        if date not in dates_to_retry:
+        if date.strftime("%Y-%m-%d") not in failed_dates:
             dates.append(date)
     return dates_to_retry + dates
 
 
-def get_all_reports() -> list[str]:
-    zip_files = list(zip_dir.glob("*.zip"))
-    existing_files = []
-    for zip_file in zip_files:
-        all_files = get_zip_files(zip_file)
-        existing_files.extend(all_files)
-    return existing_files
+def get_index_path(year: int) -> Path:
+    return zip_dir / f"{year}.index.json"
+
+
+def load_year_reports(year: int) -> set[str]:
+    """
+    Files in the zip of a year, read from a small index stored next to the zip.
+    The index is rebuilt from the zip when it is missing or was written for a zip of a different size,
+    size is used since the mtime changes with every checkout.
+    """
+    zip_file_path = zip_dir / f"{year}.zip"
+    if not zip_file_path.exists():
+        return set()
+    index_path = get_index_path(year)
+    if index_path.exists():
+        with open(index_path, "r") as file:
+            index = json.load(file)
+        if index["zip_size"] == zip_file_path.stat().st_size:
+            return set(index["files"])
+    files = set(get_zip_files(zip_file_path))
+    save_year_index(year, files)
+    return files
+
+
+def save_year_index(year: int, files: set[str]):
+    zip_file_path = zip_dir / f"{year}.zip"
+    index = {"zip_size": zip_file_path.stat().st_size, "files": sorted(files)}
+    write_json(index, get_index_path(year))
+
+
+def get_year_reports(year: int) -> set[str]:
+    if year not in existing_reports:
+        existing_reports[year] = load_year_reports(year)
+    return existing_reports[year]
+
+
+def add_to_year_index(zip_file_path: Path, arcnames: list[str]):
+    # keep the index in sync after appending to a yearly zip
+    year = int(zip_file_path.stem)
+    files = get_year_reports(year)
+    files.update(arcnames)
+    save_year_index(year, files)
 
 
 def get_zip_files(zip_file_path):
@@ -125,17 +250,17 @@ def add_files_to_zip(
     with zipfile.ZipFile(
         zip_file_path, "a", compression=zipfile.ZIP_DEFLATED
     ) as zip_ref:
+        arcnames = []
         for file_to_add in files_to_add:
             arcname = f"{zip_file_path.stem}/{directory_in_zip}/{file_to_add.name}"
             zip_ref.write(file_to_add, arcname=arcname)
+            arcnames.append(arcname)
+    add_to_year_index(zip_file_path, arcnames)
 
 
 def report_already_downloaded(file_name: str, date, format) -> bool:
     zip_file_name = f"{date.year}/{format}/{file_name}"
-    return zip_file_name in existing_reports
-
-
-bootstrap()
+    return zip_file_name in get_year_reports(date.year)
 
 
 def get_report_url(date: datetime) -> str:
@@ -155,35 +280,208 @@ def get_temp_output_path(date, format):
     return dest_dir / file_name
 
 
-dates_to_download = get_dates_to_download()
-for date in dates_to_download:
-    date_str = date.strftime("%Y-%m-%d")
-    format = get_file_format(date)
-    url = get_report_url(date)
-    file_name = Path(url).name
-    output_path = get_temp_output_path(date, format)
-    if not report_already_downloaded(file_name, date, format):
-        try:
-            download_file(url, output_path)
-            # create a zip file for each year and store the file in it
+def download_sequentially(dates_to_download):
+    for date in dates_to_download:
+        date_str = date.strftime("%Y-%m-%d")
+        format = get_file_format(date)
+        url = get_report_url(date)
+        file_name = Path(url).name
+        output_path = get_temp_output_path(date, format)
+        if not report_already_downloaded(file_name, date, format):
+            try:
+                download_file(url, output_path)
+                # create a zip file for each year and store the file in it
+                zip_file_path = zip_dir / f"{date.year}.zip"
+                with metrics.timer("zip_write_s"):
+                    add_files_to_zip(
+                        zip_file_path, [output_path], directory_in_zip=format
+                    )
+                metrics.incr("reports_downloaded")
+                print(f"Downloaded report for {date_str}")
+
+                clear_failure(date_str)
+                update_latest_downloaded_date(date)
+                flush_track_json()
+            except requests.exceptions.HTTPError as e:
+                print(f"Failed to download report for {date_str}: {e}")
+                record_failure(date_str, url, e.response.status_code)
+                update_latest_downloaded_date(date)
+                flush_track_json()
+                continue
+            except (
+                requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError,
+            ) as e:
+                print(f"Failed to download report for {date_str}: {e}")
+                record_failure(date_str, url, None)
+                update_latest_downloaded_date(date)
+                flush_track_json()
+                continue
+            output_path.unlink()
+        else:
+            metrics.incr("reports_skipped")
+            update_latest_downloaded_date(date)
+            flush_track_json()
+
+
+class RateLimiter:
+    """
+    Spaces out the start of requests to the same host by at least min_interval seconds
+    """
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_slot = {}
+
+    def wait(self, host: str):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+        time.sleep(max(0, slot - now))
+
+
+def get_session(pool_size: int) -> requests.Session:
+    # keep-alive connections, one per worker
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_report(session: requests.Session, rate_limiter: RateLimiter, url: str):
+    rate_limiter.wait(urlparse(url).netloc)
+    with metrics.timer("http_latency_s"):
+        response = session.get(url, timeout=request_timeout)
+    record_response(response)
+    response.raise_for_status()
+    return response.content
+
+
+def add_reports_to_zips(reports_by_zip: dict[Path, list[tuple[str, bytes]]]):
+    # one open of each yearly zip for all the reports of a batch
+    for zip_file_path, reports in reports_by_zip.items():
+        with zipfile.ZipFile(
+            zip_file_path, "a", compression=zipfile.ZIP_DEFLATED
+        ) as zip_ref:
+            for arcname, content in reports:
+                zip_info = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                zip_info.compress_type = zipfile.ZIP_DEFLATED
+                zip_info.external_attr = 0o644 << 16
+                zip_ref.writestr(zip_info, content)
+        add_to_year_index(zip_file_path, [arcname for arcname, _ in reports])
+
+
+def write_batch(batch):
+    """
+    Single writer for a batch of downloads, applied in date order like download_sequentially.
+    Zip appends and tracking updates are written once at the end of the batch.
+    """
+    reports_by_zip = {}
+    try:
+        for date, url, future in batch:
+            date_str = date.strftime("%Y-%m-%d")
+            if future is None:
+                # already downloaded
+                metrics.incr("reports_skipped")
+                update_latest_downloaded_date(date)
+                continue
+            try:
+                content = future.result()
+            except requests.exceptions.HTTPError as e:
+                print(f"Failed to download report for {date_str}: {e}")
+                record_failure(date_str, url, e.response.status_code)
+                update_latest_downloaded_date(date)
+                continue
+            except (
+                requests.exceptions.Timeout,
+                requests.exceptions.ConnectionError,
+            ) as e:
+                print(f"Failed to download report for {date_str}: {e}")
+                record_failure(date_str, url, None)
+                update_latest_downloaded_date(date)
+                continue
+            format = get_file_format(date)
             zip_file_path = zip_dir / f"{date.year}.zip"
-            add_files_to_zip(zip_file_path, [output_path], directory_in_zip=format)
+            arcname = f"{zip_file_path.stem}/{format}/{Path(url).name}"
+            reports_by_zip.setdefault(zip_file_path, []).append((arcname, content))
+            metrics.incr("reports_downloaded")
             print(f"Downloaded report for {date_str}")
 
-            if date_str in track_json["failed"]:
-                track_json["failed"].pop(date_str)
+            clear_failure(date_str)
             update_latest_downloaded_date(date)
-            flush_track_json()
-        except requests.exceptions.HTTPError as e:
-            print(f"Failed to download report for {date_str}: {e}")
-            track_json["failed"][date_str] = {
-                "url": url,
-                "response_code": e.response.status_code,
-            }
-            update_latest_downloaded_date(date)
-            flush_track_json()
-            continue
-        output_path.unlink()
-    else:
-        update_latest_downloaded_date(date)
+    finally:
+        # like the sequential path, an unexpected error stops the run but keeps everything before it
+        with metrics.timer("zip_write_s"):
+            add_reports_to_zips(reports_by_zip)
         flush_track_json()
+
+
+def download_concurrently(
+    dates_to_download, concurrency: int, requests_per_second: float, batch_size: int
+):
+    session = get_session(concurrency)
+    rate_limiter = RateLimiter(1 / requests_per_second)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for start in range(0, len(dates_to_download), batch_size):
+            batch = []
+            for date in dates_to_download[start : start + batch_size]:
+                format = get_file_format(date)
+                url = get_report_url(date)
+                if report_already_downloaded(Path(url).name, date, format):
+                    batch.append((date, url, None))
+                else:
+                    future = executor.submit(fetch_report, session, rate_limiter, url)
+                    batch.append((date, url, future))
+            write_batch(batch)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Download NPP daily generation reports"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="parallel downloads, 1 downloads one report at a time",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=4,
+        help="max requests per second to the host when downloading concurrently",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=50,
+        help="reports written to the zips and track.json at a time when downloading concurrently",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="dump cProfile stats of the run next to the metrics",
+    )
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    metrics.start_run("download_reports", metrics_dir, args.profile or None)
+    bootstrap()
+    try:
+        with metrics.timer("stage.plan_s"):
+            dates_to_download = get_dates_to_download()
+        with metrics.timer("stage.download_s"):
+            if args.concurrency > 1:
+                download_concurrently(
+                    dates_to_download, args.concurrency, args.rate, args.batch_size
+                )
+            else:
+                download_sequentially(dates_to_download)
+    finally:
+        track_store.close()
+        metrics.finish_run(args=vars(args))
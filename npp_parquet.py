@@ -0,0 +1,195 @@
+"""
+Columnar copy of the NPP daily generation tables (region, state, sector, station_type, station, unit).
+Each table is stored as parquet files partitioned by fiscal year and month:
+    parquet/<table>/fiscal_year=2023-24/month=2024-01/data.parquet
+* Region, State, Sector, Station Type and Station are dictionary encoded
+* generation and capacity values are stored as numbers, the csv files keep the values as reported
+* read_table only opens the partitions overlapping the requested dates and reads only the requested columns
+
+Build the parquet tables from the existing csv files:
+    python npp_parquet.py build
+"""
+
+import argparse
+import os
+from datetime import date, datetime
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+csv_dir = Path("./data/npp/daily-generation/csv/")
+parquet_dir = Path("./data/npp/daily-generation/parquet/")
+tables = ["region", "state", "sector", "station_type", "station", "unit"]
+date_col = "Date"
+dictionary_columns = ["Region", "State", "Sector", "Station Type", "Station"]
+numeric_columns = [
+    "Monitored CAP in MW",
+    "Generation / Today's Program",
+    "Generation / Today's Actual",
+    "Generation / FY YTD Program",
+    "Generation / FY YTD Actual",
+    "Coal Stock in Days",
+    "CAP under outage",
+]
+partition_file_name = "data.parquet"
+
+
+def get_fiscal_year(day: date) -> str:
+    # Indian fiscal year, April to March
+    start_year = day.year if day.month >= 4 else day.year - 1
+    return f"{start_year}-{(start_year + 1) % 100:02d}"
+
+
+def get_partition_path(table_dir: Path, day: date) -> Path:
+    return (
+        table_dir
+        / f"fiscal_year={get_fiscal_year(day)}"
+        / f"month={day.strftime('%Y-%m')}"
+        / partition_file_name
+    )
+
+
+def get_schema(columns) -> pa.Schema:
+    fields = []
+    for column in columns:
+        if column == date_col:
+            type = pa.date32()
+        elif column in dictionary_columns:
+            type = pa.dictionary(pa.int32(), pa.string())
+        elif column in numeric_columns:
+            type = pa.float64()
+        else:
+            type = pa.string()
+        fields.append(pa.field(column, type))
+    return pa.schema(fields)
+
+
+def to_arrow(df: pd.DataFrame) -> pa.Table:
+    df = df.copy()
+    for column in df.columns:
+        if column == date_col:
+            df[column] = pd.to_datetime(df[column]).dt.date
+        elif column in numeric_columns:
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+        else:
+            df[column] = df[column].astype("string").astype("category")
+    return pa.Table.from_pandas(df, schema=get_schema(df.columns), preserve_index=False)
+
+
+def write_partition(df: pd.DataFrame, path: Path):
+    """
+    Merge the rows into a month partition. Dates in df replace the rows of the same dates already in
+    the partition, so a re-parsed report does not leave its old rows behind.
+    """
+    if path.exists():
+        existing = pd.read_parquet(path)
+        existing = existing[~existing[date_col].isin(set(df[date_col]))]
+        df = pd.concat([existing.astype(object), df.astype(object)], ignore_index=True)
+    df = df.sort_values(date_col, kind="stable")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".tmp")
+    pq.write_table(to_arrow(df), temp_path, use_dictionary=dictionary_columns)
+    os.replace(temp_path, path)
+
+
+def write_table(df: pd.DataFrame, table_dir: Path):
+    df = df.copy()
+    df[date_col] = pd.to_datetime(df[date_col]).dt.date
+    partitions = df[date_col].map(lambda day: get_partition_path(table_dir, day))
+    for path, partition_df in df.groupby(partitions, sort=True):
+        write_partition(partition_df, path)
+
+
+def write_tables(dfs: dict[str, pd.DataFrame], parquet_dir: Path = parquet_dir):
+    for table, df in dfs.items():
+        if len(df) > 0:
+            write_table(df, parquet_dir / table)
+
+
+def to_date(value) -> date:
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+def get_partition_files(table_dir: Path, start_date=None, end_date=None):
+    # partition pruning, only the months overlapping the date range
+    start_month = start_date.strftime("%Y-%m") if start_date else None
+    end_month = end_date.strftime("%Y-%m") if end_date else None
+    files = []
+    for path in sorted(table_dir.glob(f"fiscal_year=*/month=*/{partition_file_name}")):
+        month = path.parent.name.split("=", maxsplit=1)[1]
+        if start_month and month < start_month:
+            continue
+        if end_month and month > end_month:
+            continue
+        files.append(path)
+    return files
+
+
+def as_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+
+def read_table(
+    table: str,
+    start_date=None,
+    end_date=None,
+    region=None,
+    state=None,
+    station=None,
+    columns=None,
+    parquet_dir: Path = parquet_dir,
+) -> pd.DataFrame:
+    """
+    Rows of one table, filtered by date range (inclusive, date or "YYYY-MM-DD") and by region, state
+    and station (a name or a list of names). columns limits the columns that are read.
+    """
+    assert table in tables, f"Unknown table: {table}"
+    start_date = to_date(start_date)
+    end_date = to_date(end_date)
+    files = get_partition_files(parquet_dir / table, start_date, end_date)
+    if len(files) == 0:
+        return pd.DataFrame(columns=columns)
+
+    dataset = ds.dataset([str(file) for file in files], format="parquet")
+    filters = []
+    if start_date:
+        filters.append(ds.field(date_col) >= pa.scalar(start_date, pa.date32()))
+    if end_date:
+        filters.append(ds.field(date_col) <= pa.scalar(end_date, pa.date32()))
+    for column, value in [("Region", region), ("State", state), ("Station", station)]:
+        if value is None:
+            continue
+        if column not in dataset.schema.names:
+            raise ValueError(f"{table} table has no {column} column")
+        filters.append(ds.field(column).isin(as_list(value)))
+
+    expression = None
+    for condition in filters:
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def build_from_csv(csv_dir: Path = csv_dir, parquet_dir: Path = parquet_dir):
+    # (re)create the parquet tables from the csv output
+    for table in tables:
+        csv_path = csv_dir / f"{table}.csv"
+        if not csv_path.exists():
+            continue
+        df = pd.read_csv(csv_path, dtype=str, keep_default_na=False, na_values=[""])
+        write_table(df, parquet_dir / table)
+        print(f"{len(df)} rows written for {table}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NPP daily generation parquet tables")
+    parser.add_argument("command", choices=["build"])
+    args = parser.parse_args()
+    if args.command == "build":
+        build_from_csv()
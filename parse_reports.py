@@ -1,20 +1,37 @@
 """
-Only handles xls reports.
-PDF files are parsed to csv, but the work to parse them and conveert to structred data is not done yet
+Handles xls reports, PDF reports (up to 2018-03-31, see get_file_format of download_reports) are parsed with
+--include-pdf.
+* tables extracted from a PDF are cached by the hash of the report, a report goes through tabula only once
+* PDF reports are parsed in their own worker processes, each keeps one JVM running (needs jpype)
 TODO:
 * Away to not process all the reports for a fresh clone.
-* Process PDF reports
 """
 
+import argparse
+import hashlib
+import importlib.util
+import io
+import math
+import os
 import traceback
 import zipfile
 import itertools
+import json
+import re
 import tabula
+import xlrd
 import csv
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from tqdm import tqdm
 import concurrent.futures
+import functools
+import time
+from datetime import datetime
+import threading
+
+from src.meritindia import metrics
 
 pd.options.mode.chained_assignment = None
 
@@ -22,8 +39,17 @@ pd.options.mode.chained_assignment = None
 src_dir = Path("./data/npp/daily-generation/raw/")
 
 output_dir = Path("./data/npp/daily-generation/csv/")
+manifest_path = Path("./data/npp/daily-generation/parse_manifest.json")
+# sizes of the csv files before a run appends to them, exists while the rows are being written
+append_log_path = Path("./data/npp/daily-generation/parse_manifest.appending.json")
+parquet_dir = Path("./data/npp/daily-generation/parquet/")
+metrics_dir = Path("./data/metrics/")
+# tables extracted from pdf reports, keyed by the sha256 of the report
+pdf_cache_dir = Path("./data/npp/daily-generation/pdf-cache/")
 data_exts = [".pdf", ".xls"]
 no_of_workers = 10
+# bytes at the end of a yearly zip that are hashed to detect changes, more than its central directory
+zip_tail_size = 1 << 20
 row_type_col = "Row Type"
 region_col = "Region"
 state_col = "State"
@@ -33,6 +59,36 @@ station_col = "Station"
 unit_col = "Unit"
 date_col = "Date"
 format_col = "Source Format"
+# strings pd.read_csv reads as missing values by default (keep_default_na)
+csv_na_values = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+# header and filler rows repeated on every page of a report
+filler_values = [
+    "REGION WISE",
+    "POWER STATION",
+    "OPERATION PERFORMANCE MONITORING DIVISION",
+]
+whitespace_pattern = re.compile(r"\s+")
+filler_pattern = re.compile("|".join(filler_values))
 """
 The regions in this dataset are based on power grid regions and hence these are the only regions
 1) Northern
@@ -94,79 +150,301 @@ def clean_df(df):
 
 def drop_unnecessary_rows(df):
     # drop rows if all values are null/nan or empty strings or if the row contains any of the following strings
-    filter_values = [
-        "REGION WISE",
-        "POWER STATION",
-        "OPERATION PERFORMANCE MONITORING DIVISION",
-    ]
     for column in df.columns:
         if df[column].dtype == "object" or df[column].dtype == "string":
             df = df[
-                ~df[column].str.contains("|".join(filter_values), regex=True, na=False)
+                ~df[column].str.contains("|".join(filler_values), regex=True, na=False)
             ]
     df.reset_index(drop=True, inplace=True)
     return df
 
 
-def reports_to_parse():
-    # reports that are not processed yet based on which years data is already part of region.csv
+def clean_text(value):
+    # "nan" and empty strings are missing values, whitespace runs become a single space
+    if not isinstance(value, str):
+        if pd.isna(value):
+            return pd.NA
+        value = str(value)
+    if value == "nan":
+        return pd.NA
+    value = whitespace_pattern.sub(" ", value).strip()
+    return value if value != "" else pd.NA
+
+
+def clean_frame(df):
+    """
+    clean_df with filler row detection in a single pass over the text cells.
+    * every cell is cleaned once with the precompiled whitespace pattern
+    * the cleaned cells of a row are joined and searched once for filler values
+    Returns the cleaned frame and a boolean mask of its filler rows.
+    """
+    text_columns = [
+        column
+        for column in df.columns
+        if df[column].dtype == "object" or df[column].dtype == "string"
+    ]
+    rows = df[text_columns].to_numpy(dtype=object)
+    cleaned = np.empty(rows.shape, dtype=object)
+    filler_rows = np.zeros(len(rows), dtype=bool)
+    for i, row in enumerate(rows):
+        texts = [clean_text(value) for value in row]
+        cleaned[i] = texts
+        # cells are joined with a character that can't be part of a match
+        joined = "\0".join(text for text in texts if text is not pd.NA)
+        filler_rows[i] = filler_pattern.search(joined) is not None
+
+    df = df.copy()
+    for j, column in enumerate(text_columns):
+        df[column] = pd.array(cleaned[:, j], dtype="string")
+    filler_rows = pd.Series(filler_rows, index=df.index)
+    df.dropna(how="all", axis=1, inplace=True)
+    df.dropna(how="all", axis=0, inplace=True)
+    return df, filler_rows[df.index]
+
+
+def clean_rows_legacy(df, date):
+    """
+    Reference for clean_rows, cleans every column with separate passes. Kept to verify and benchmark clean_rows.
+    """
+    df.replace("nan", pd.NA, inplace=True)
+    clean_df(df)
+    region_search = df.isin(["NORTHERN"]).any(axis=1)
+    if not region_search.any():
+        print(f"Region row not found for {date}")
+        return
+    region_total_row = df[region_search].index[0]
+    df = df.iloc[region_total_row:]
+    df = drop_unnecessary_rows(df)
+    clean_df(df)
+    return df
+
+
+def clean_rows(df, date):
+    """
+    * replace "nan"
+    * drop rows, columns with all nulls
+    * drop header, filler rows and the rows before the first region
+    """
+    df, filler_rows = clean_frame(df)
+    region_search = df.isin(["NORTHERN"]).any(axis=1)
+    if not region_search.any():
+        print(f"Region row not found for {date}")
+        return
+    region_total_row = df[region_search].index[0]
+    # the row label is used as a position, same as before
+    df = df.iloc[region_total_row:]
+    df = df[~filler_rows.iloc[region_total_row:].to_numpy()]
+    df.reset_index(drop=True, inplace=True)
+    # columns only used before the first region are empty now
+    df.dropna(how="all", axis=1, inplace=True)
+    return df
+
+
+def load_manifest():
+    """
+    Reports that were already parsed, keyed by zip member name.
+    * reports: {member: {"zip", "date", "crc", "size", "status"}}, status is parsed or failed
+    * zips: size and central directory hash of each yearly zip when it was last scanned, unchanged zips are
+      not opened
+    * run: id of the run that saved it, see recover_interrupted_write
+    """
+    if manifest_path.exists():
+        with open(manifest_path, "r") as file:
+            return json.load(file)
+    # first run with a manifest, reports of the dates already in region.csv count as parsed
+    return {"zips": {}, "reports": {}, "seed_dates": sorted(get_parsed_dates())}
+
+
+def save_manifest(manifest):
+    manifest.pop("seed_dates", None)
+    temp_path = manifest_path.with_suffix(".tmp")
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+
+def get_parsed_dates():
     region_src = output_dir / "region.csv"
-    if region_src.exists():
-        df = pd.read_csv(region_src)
-        dates = df[date_col].unique()
-    else:
-        dates = []
-
-    for file in src_dir.iterdir():
-        if file.suffix == ".zip":
-            # unzip file using python module, suggest code
-            with zipfile.ZipFile(file, "r") as zip_ref:
-                files_in_zip = zip_ref.namelist()
-                files_to_parse = []
-                for file_in_zip in files_in_zip:
-                    file_path = Path(file_in_zip)
-                    date = date_from_report_name(file_path)
-                    if file_path.suffix == ".xls" and date not in dates:
-                        # only process xls reports which are not already processed/ PDF parsing requires special handling
-                        files_to_parse.append(file_path)
-                if len(files_to_parse) > 0:
-                    zip_ref.extractall(
-                        src_dir, members=map(lambda x: str(x), files_to_parse)
-                    )
-                    for report in files_to_parse:
-                        yield src_dir / report
+    if not region_src.exists():
+        return set()
+    with open(region_src, "r", newline="") as file:
+        reader = csv.reader(file)
+        date_idx = next(reader).index(date_col)
+        return {row[date_idx] for row in reader}
 
 
-def convert_pdf_to_csv(report_path: Path, output_path: Path):
+def get_zip_stat(zip_path: Path):
+    """
+    Size and a hash of the end of the zip, which holds the central directory (names, CRCs and sizes of the
+    members). The mtime is not used, it changes with every checkout.
+    """
+    size = zip_path.stat().st_size
+    with open(zip_path, "rb") as file:
+        file.seek(max(0, size - zip_tail_size))
+        tail = file.read()
+    return {"size": size, "tail_sha256": hashlib.sha256(tail).hexdigest()}
+
+
+def start_append(run_id):
+    # sizes of the csv files before the rows of run_id are appended
+    sizes = {path.name: path.stat().st_size for path in output_dir.glob("*.csv")}
+    temp_path = append_log_path.with_suffix(".tmp")
+    with open(temp_path, "w") as file:
+        json.dump({"run": run_id, "sizes": sizes}, file)
+    os.replace(temp_path, append_log_path)
+
+
+def recover_interrupted_write(manifest):
+    """
+    A run that stopped after appending (some) rows but before saving its manifest would append them again
+    in the next run. The csv files are cut back to their sizes before that append, the reports are still
+    planned by the manifest and parsed again. Nothing to do if the manifest of that run was saved.
+    """
+    if not append_log_path.exists():
+        return
+    with open(append_log_path, "r") as file:
+        append_log = json.load(file)
+    if manifest.get("run") != append_log["run"]:
+        print("Previous run stopped while writing, removing its rows")
+        for path in output_dir.glob("*.csv"):
+            size = append_log["sizes"].get(path.name)
+            if size is None:
+                path.unlink()
+            elif path.stat().st_size > size:
+                with open(path, "r+b") as file:
+                    file.truncate(size)
+    append_log_path.unlink()
+
+
+def get_manifest_entry(zip_path: Path, zip_info: zipfile.ZipInfo):
+    return {
+        "zip": zip_path.name,
+        "date": date_from_report_name(Path(zip_info.filename)),
+        "crc": zip_info.CRC,
+        "size": zip_info.file_size,
+    }
+
+
+def plan_reports(manifest, retry_failed=False, include_pdf=False):
+    """
+    Members of the yearly zips which are new or whose bytes changed since they were parsed.
+    Zips which did not change since the last scan are skipped, so planning only touches new reports.
+    """
+    reports = manifest["reports"]
+    seed_dates = set(manifest.get("seed_dates", []))
+    report_exts = data_exts if include_pdf else [".xls"]
+    planned = {}
+    for zip_path in sorted(src_dir.glob("*.zip")):
+        if manifest["zips"].get(zip_path.name) == get_zip_stat(zip_path):
+            continue
+        with zipfile.ZipFile(zip_path, "r") as zip_ref:
+            for zip_info in zip_ref.infolist():
+                # PDF reports are only parsed on request, they need java and are much slower
+                if Path(zip_info.filename).suffix not in report_exts:
+                    continue
+                entry = get_manifest_entry(zip_path, zip_info)
+                previous = reports.get(zip_info.filename)
+                if previous is None and entry["date"] in seed_dates:
+                    reports[zip_info.filename] = {**entry, "status": "parsed"}
+                elif previous is None or (
+                    previous["crc"] != entry["crc"] or previous["size"] != entry["size"]
+                ):
+                    planned[zip_info.filename] = entry
+        manifest["zips"][zip_path.name] = get_zip_stat(zip_path)
+
+    if retry_failed:
+        for member, previous in reports.items():
+            if previous["status"] == "failed" and member not in planned:
+                planned[member] = {
+                    key: value for key, value in previous.items() if key != "status"
+                }
+    return planned
+
+
+def reports_to_parse(planned):
+    # extract the planned reports from the yearly zips, in the same order as planned
+    members_by_zip = {}
+    for member, entry in planned.items():
+        members_by_zip.setdefault(entry["zip"], []).append(member)
+    for zip_name, members in members_by_zip.items():
+        with zipfile.ZipFile(src_dir / zip_name, "r") as zip_ref:
+            zip_ref.extractall(src_dir, members=members)
+    return [src_dir / member for member in planned]
+
+
+def remove_dates_from_csv(output_dir: Path, dates):
+    """
+    Drop the rows of the given dates from the output tables, used when a report has to be re-parsed.
+    Rows are filtered line by line so that the other rows are kept byte for byte.
+    """
+    dates = set(dates)
+    for file_path in output_dir.glob("*.csv"):
+        temp_path = file_path.with_suffix(".tmp")
+        with open(file_path, "r", newline="") as src, open(
+            temp_path, "w", newline=""
+        ) as dest:
+            header = src.readline()
+            date_idx = next(csv.reader([header])).index(date_col)
+            dest.write(header)
+            for line in src:
+                if next(csv.reader([line]))[date_idx] not in dates:
+                    dest.write(line)
+        os.replace(temp_path, file_path)
+
+
+def extract_pdf_tables(report) -> pd.DataFrame:
     # tables = camelot.read_pdf(str(report), pages="1-end")
     """
     for ex first pdf report 2017-09-01.pdf itself gets parsed incorrectly
     tabula seems to be better at these tables than camelot. though, camelot also is messing up Unit level generation rows.
     Tabula seems to be also faster than camelot
+    With jpype installed tabula keeps one JVM running in the process, instead of starting java for every report
     """
-    tables = tabula.read_pdf(
-        str(report_path), pages="all", pandas_options={"header": None}
-    )
+    tables = tabula.read_pdf(report, pages="all", pandas_options={"header": None})
     df = pd.DataFrame()
     for i, table in enumerate(tables):
         df = pd.concat([df, table], ignore_index=True)
+    return df
+
+
+def convert_pdf_to_csv(report_path: Path, output_path: Path):
+    df = extract_pdf_tables(str(report_path))
     df.to_csv(output_path, index=False, quoting=csv.QUOTE_NONNUMERIC)
     return output_path
 
 
+def read_pdf_bytes(data: bytes) -> pd.DataFrame:
+    """
+    Tables of a pdf report held in memory, the same frame as convert_pdf_to_csv followed by read_csv.
+    Extracted tables are cached by the hash of the report bytes, so a report is only run through
+    tabula once, however many times it is parsed.
+    """
+    cache_path = pdf_cache_dir / f"{hashlib.sha256(data).hexdigest()}.csv"
+    if not (cache_path.exists() and cache_path.stat().st_size > 0):
+        df = extract_pdf_tables(io.BytesIO(data))
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        df.to_csv(temp_path, index=False, quoting=csv.QUOTE_NONNUMERIC)
+        os.replace(temp_path, cache_path)
+    return pd.read_csv(cache_path, header=None)
+
+
 def convert_excel_to_csv(report_path: Path, output_path: Path):
     df = pd.read_excel(report_path)
     df.to_csv(output_path, index=False)
     return output_path
 
 
+def get_converted_csv_path(report_path: Path):
+    return output_dir / report_path.suffix[1:] / report_path.with_suffix(".csv").name
+
+
 def convert_report_to_csv(report_path: Path):
     ext = report_path.suffix
     assert ext in data_exts
     src_report_format = report_path.suffix[1:]
-    format_dir = output_dir / src_report_format
-    format_dir.mkdir(parents=True, exist_ok=True)
-    output_path = format_dir / report_path.with_suffix(".csv").name
+    output_path = get_converted_csv_path(report_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
     if output_path.exists() and output_path.stat().st_size > 0:
         return output_path
     try:
@@ -187,16 +465,9 @@ def clean_report(df, format, date):
     * drop header, filler rows
     """
     expected_columns = 15 if format == "xls" else 12
-    df.replace("nan", pd.NA, inplace=True)
-    clean_df(df)
-    region_search = df.isin(["NORTHERN"]).any(axis=1)
-    if not region_search.any():
-        print(f"Region row not found for {date}")
+    df = clean_rows(df, date)
+    if df is None:
         return
-    region_total_row = df[region_search].index[0]
-    df = df.iloc[region_total_row:]
-    df = drop_unnecessary_rows(df)
-    clean_df(df)
     if format == "pdf":
         df = df.astype("object")
         df.insert(1, "Outage Type", pd.NA)
@@ -222,10 +493,11 @@ def clean_report(df, format, date):
     return df
 
 
-def add_additional_columns(daily_df):
+def add_additional_columns_iterrows(daily_df):
     """
     Fill up the plant metadata from earlier rows
     Add date and format columns
+    Row by row reference implementation, kept to verify and benchmark add_additional_columns
     """
     o_power_st_col = 2
     o_sector_col = 5 if daily_df.shape[1] == 17 else 4
@@ -318,15 +590,183 @@ def add_additional_columns(daily_df):
     return daily_df
 
 
+def last_event_position(mask):
+    # position of the latest row (at or before each row) where mask is set, -1 if there is none yet
+    positions = np.where(mask, np.arange(len(mask)), -1)
+    return np.maximum.accumulate(positions) if len(positions) > 0 else positions
+
+
+def fill_from_events(mask, values):
+    # value from the latest row where mask is set, None before the first such row
+    last = last_event_position(mask)
+    return np.where(last >= 0, values[last], None)
+
+
+def add_additional_columns(daily_df):
+    """
+    Fill up the plant metadata from earlier rows
+    Add date and format columns
+    Column wise version of add_additional_columns_iterrows, produces the same output.
+    * rows are classified with masks on the power station column
+    * region, state, sector, type and station are forward filled from the last row that set them,
+      a row of a higher level resets the levels below it
+    """
+    o_power_st_col = 2
+    o_sector_col = 5 if daily_df.shape[1] == 17 else 4
+    o_station_type_col = 4
+    o_unit_no_col = 3
+
+    all_names = daily_df[o_power_st_col].to_numpy(dtype=object)
+    # the row by row version stops at the first row without a name
+    null_names = pd.isnull(all_names)
+    faulty = null_names.any()
+    n_rows = null_names.argmax() if faulty else len(all_names)
+
+    names = pd.Series(all_names[:n_rows], dtype=object)
+    sectors = daily_df[o_sector_col].to_numpy(dtype=object)[:n_rows]
+    types = daily_df[o_station_type_col].to_numpy(dtype=object)[:n_rows]
+    unit_nos = daily_df[o_unit_no_col].to_numpy(dtype=object)[:n_rows]
+
+    is_region = (names == "REGION TOTAL").to_numpy()
+    is_state = (names == "STATE TOTAL").to_numpy() & ~is_region
+    is_sector = names.str.startswith("SECTOR:", na=False).to_numpy(dtype=bool)
+    is_sector &= ~(is_region | is_state)
+    is_type = names.str.startswith("TYPE:", na=False).to_numpy(dtype=bool)
+    is_type &= ~(is_region | is_state | is_sector)
+    is_unit_name = names.str.startswith("Unit", na=False).to_numpy(dtype=bool)
+    is_marker = is_region | is_state | is_sector | is_type
+
+    # region and state names are in the row before the total row, looked up by position like iloc[idx - 1]
+    total_rows = np.flatnonzero(is_region | is_state)
+    labels = daily_df.index.to_numpy()[total_rows]
+    previous_names = np.full(n_rows, None, dtype=object)
+    previous_names[total_rows] = all_names[labels - 1]
+
+    region = fill_from_events(is_region, previous_names)
+    state = fill_from_events(
+        is_region | is_state, np.where(is_state, previous_names, None)
+    )
+    sector = fill_from_events(
+        is_region | is_state | is_sector, np.where(is_sector, sectors, None)
+    )
+    type = fill_from_events(is_marker, np.where(is_type, types, None))
+
+    # every marker row starts a new segment, stations and units only show up in segments with a type.
+    # first row of such a segment is always a station, after that rows starting with "Unit" are units
+    after_marker = (
+        np.concatenate(([False], is_marker[:-1])) if n_rows > 0 else is_marker
+    )
+    in_typed_segment = ~is_marker & pd.notnull(type)
+    is_station = in_typed_segment & (after_marker | ~is_unit_name)
+    is_unit = in_typed_segment & ~after_marker & is_unit_name
+    station = fill_from_events(
+        is_marker | is_station, np.where(is_station, names.to_numpy(), None)
+    )
+
+    unit = np.full(n_rows, pd.NA, dtype=object)
+    unit_rows = np.flatnonzero(is_unit)
+    unit[unit_rows] = [
+        f"{name} {int(float(unit_no))}"
+        for name, unit_no in zip(names.to_numpy()[unit_rows], unit_nos[unit_rows])
+    ]
+    if faulty:
+        return None
+
+    row_type = np.full(n_rows, pd.NA, dtype=object)
+    row_type[is_region] = "Region"
+    row_type[is_state] = "State"
+    row_type[is_sector] = "Sector"
+    row_type[is_type] = "Station Type"
+    row_type[is_station] = "Station"
+    row_type[is_unit] = "Unit"
+    classified = is_marker | is_station | is_unit
+
+    def only_classified(values):
+        values = values.astype(object)
+        values[~classified] = pd.NA
+        return values
+
+    daily_df.insert(0, row_type_col, row_type)
+    daily_df.insert(1, region_col, only_classified(region))
+    daily_df.insert(2, state_col, only_classified(state))
+    daily_df.insert(3, sector_col, only_classified(sector))
+    daily_df.insert(4, station_type_col, only_classified(type))
+    daily_df.insert(5, station_col, only_classified(station))
+    daily_df.insert(6, unit_col, unit)
+
+    daily_df.drop(
+        columns=[o_power_st_col, o_sector_col, o_station_type_col, o_unit_no_col],
+        inplace=True,
+    )
+
+    daily_df.columns = get_final_columns()
+    return daily_df
+
+
 def get_clean_csv(csv_path, format, date) -> pd.DataFrame:
     """
     Add additional columns for format and date and return a combined df
     """
 
     df = pd.read_csv(csv_path, header=None)
+    return get_clean_df(df, format, date)
+
+
+def get_row_label_value(df, names, label):
+    """
+    Value of "SECTOR:"/"TYPE:" rows of a pdf report. Usually part of the name ("TYPE: THERMAL"),
+    otherwise the first value in the rest of the row.
+    """
+    value = names.str.extract(rf"^{label}:\s*(.*)$", expand=False)
+    value = value.astype("object").where(value.fillna("") != "", None)
+    # first non missing value after the name, the values are often numbers, not strings
+    rest = df.iloc[:, 1:].to_numpy(dtype="object")
+    has_value = pd.notna(rest)
+    first_value = rest[np.arange(len(rest)), has_value.argmax(axis=1)]
+    rest_of_row = pd.Series(first_value, index=df.index).where(has_value.any(axis=1))
+    is_label_row = names.str.startswith(f"{label}:", na=False)
+    return value.where(value.notna(), rest_of_row).where(is_label_row, pd.NA)
+
+
+def align_pdf_report(df, date):
+    """
+    Lay out a cleaned pdf report like the xls reports (name, unit no, type, sector, outage type, values),
+    so add_additional_columns handles both formats.
+    * unit rows are named "Unit 1" in pdf reports, split into "Unit" and the unit number
+    * sector and type of "SECTOR:"/"TYPE:" rows go to their own columns
+    * reports with a different number of columns are skipped
+    """
+    if df.shape[1] != 12:
+        print(f"Unexpected pdf layout for {date}", df.columns)
+        return
+    df = df.reset_index(drop=True).astype("object")
+    names = df.iloc[:, 0].astype("string")
+    unit_no = names.str.extract(r"^Unit\s*(\d+)", expand=False)
+    is_unit = unit_no.notna()
+    is_label_row = names.str.match(r"^(TYPE|SECTOR):", na=False)
+    aligned = pd.concat(
+        [
+            names.where(~is_unit, "Unit"),
+            unit_no,
+            get_row_label_value(df, names, "TYPE"),
+            get_row_label_value(df, names, "SECTOR"),
+            # like in the xls reports, "SECTOR:"/"TYPE:" rows have no values
+            df.iloc[:, 1:].mask(is_label_row, pd.NA),
+        ],
+        axis=1,
+    ).astype("object")
+    aligned.columns = range(aligned.shape[1])
+    return aligned
+
+
+def get_clean_df(df, format, date) -> pd.DataFrame:
     df = clean_report(df, format, date)
     if df is None:
         return
+    if format == "pdf":
+        df = align_pdf_report(df, date)
+        if df is None:
+            return
     df.insert(0, date_col, date)
     df.insert(1, format_col, format)
     return df
@@ -345,6 +785,161 @@ def get_trnsformed_df(raw_report) -> pd.DataFrame:
     return add_additional_columns(df)
 
 
+def get_cell_value(ctype, value, datemode):
+    # value of a cell as pd.read_excel (xlrd engine) reads it, None for empty cells
+    if ctype == xlrd.XL_CELL_TEXT:
+        return value
+    if ctype in (xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK, xlrd.XL_CELL_ERROR):
+        return None
+    if ctype == xlrd.XL_CELL_NUMBER:
+        return int(value) if value == int(value) else value
+    if ctype == xlrd.XL_CELL_BOOLEAN:
+        return bool(value)
+    if ctype == xlrd.XL_CELL_DATE:
+        try:
+            date = xlrd.xldate.xldate_as_datetime(value, datemode)
+        except OverflowError:
+            return value
+        if date.timetuple()[0:3] == ((1904, 1, 1) if datemode else (1899, 12, 31)):
+            return date.time()
+        return date
+    return value
+
+
+def is_text_column(values) -> bool:
+    """
+    True if read_excel keeps the column as objects, to_csv then writes each value with str().
+    A text value that is not a number, a bool or an NA marker is enough. Numeric columns are written
+    by to_csv as floats ("3.0") and are left to read_excel.
+    """
+    for value in values:
+        if not isinstance(value, str) or value in csv_na_values:
+            continue
+        if value.strip() in ["True", "TRUE", "true", "False", "FALSE", "false"]:
+            continue
+        try:
+            float(value)
+        except ValueError:
+            return True
+    return False
+
+
+def get_header_names(values) -> list[str]:
+    """
+    Column names read_excel gives the header row, like its python parser:
+    "Unnamed: <i>" for empty cells and ".<n>" for duplicates, named columns are numbered before unnamed ones
+    """
+    names = []
+    unnamed = []
+    for idx, value in enumerate(values):
+        if value is None or value == "":
+            unnamed.append(idx)
+            names.append(f"Unnamed: {idx}")
+        else:
+            names.append(str(value))
+    counts = {}
+    for idx in [idx for idx in range(len(names)) if idx not in unnamed] + unnamed:
+        name = names[idx]
+        count = counts.get(name, 0)
+        while count > 0:
+            counts[names[idx]] = count + 1
+            name = f"{names[idx]}.{count}"
+            count = count + 1 if name in names else counts.get(name, 0)
+        names[idx] = name
+        counts[name] = count + 1
+    return names
+
+
+def read_excel_bytes(data: bytes) -> pd.DataFrame:
+    """
+    Decode an xls report held in memory.
+    Returns the same frame as convert_excel_to_csv followed by pd.read_csv(header=None), without the
+    text round trip. The cells are read with xlrd, in a column with text read_csv keeps every value as the text
+    to_csv wrote: header row as the first row, str() of the values and read_csv's NA markers missing.
+    Reports with a column read_excel would read as numbers or dates go through read_excel, to_csv and read_csv
+    """
+    book = xlrd.open_workbook(file_contents=data, on_demand=True)
+    sheet = book.sheet_by_index(0)
+    # most cells are text or empty, only the other cells go through get_cell_value
+    simple_types = {xlrd.XL_CELL_TEXT, xlrd.XL_CELL_EMPTY, xlrd.XL_CELL_BLANK}
+    rows = []
+    for row_idx in range(sheet.nrows):
+        types = sheet.row_types(row_idx)
+        values = sheet.row_values(row_idx)
+        rows.append(
+            [
+                (
+                    (value or None)
+                    if ctype in simple_types
+                    else get_cell_value(ctype, value, book.datemode)
+                )
+                for ctype, value in zip(types, values)
+            ]
+        )
+    columns = list(zip(*rows))
+    if len(rows) < 2 or not all(is_text_column(column[1:]) for column in columns):
+        buffer = io.StringIO()
+        pd.read_excel(io.BytesIO(data)).to_csv(buffer, index=False)
+        buffer.seek(0)
+        return pd.read_csv(buffer, header=None)
+    na_values = set(csv_na_values)
+    return pd.DataFrame(
+        {
+            idx: [
+                np.nan if text in na_values else text
+                for text in [name] + ["" if v is None else str(v) for v in column[1:]]
+            ]
+            for idx, (name, column) in enumerate(
+                zip(get_header_names(rows[0]), columns)
+            )
+        },
+        dtype=object,
+    )
+
+
+# yearly zips opened by the workers of this process, see get_open_zip
+open_zips = {}
+open_zips_lock = threading.Lock()
+
+
+def get_open_zip(zip_path: Path) -> zipfile.ZipFile:
+    # each yearly zip is opened (and its central directory read) once per process, not once per report.
+    # ZipFile reads of different members from several threads are safe
+    with open_zips_lock:
+        if zip_path not in open_zips:
+            open_zips[zip_path] = zipfile.ZipFile(zip_path, "r")
+        return open_zips[zip_path]
+
+
+def close_open_zips():
+    with open_zips_lock:
+        for zip_ref in open_zips.values():
+            zip_ref.close()
+        open_zips.clear()
+
+
+def get_zip_member_df(zip_ref: zipfile.ZipFile, member: str) -> pd.DataFrame:
+    # same as get_trnsformed_df, but the report is read from the open yearly zip into memory
+    report_path = Path(member)
+    format = report_path.suffix[1:]
+    date = date_from_report_name(report_path)
+    try:
+        data = zip_ref.read(member)
+        if format == "pdf":
+            df = read_pdf_bytes(data)
+        else:
+            df = read_excel_bytes(data)
+    except Exception as e:
+        print(f"Failed to read {member} from {zip_ref.filename}")
+        print(e)
+        return None
+    df = get_clean_df(df, format, date)
+    if df is None:
+        return None
+    df.columns = range(len(df.columns))
+    return add_additional_columns(df)
+
+
 def add_rows_to_file(file_path, df):
     if not file_path.exists():
         df.to_csv(file_path, index=False)
@@ -352,7 +947,8 @@ def add_rows_to_file(file_path, df):
         df.to_csv(file_path, mode="a", header=False, index=False)
 
 
-def write_to_csv(all_df: pd.DataFrame, output_dir: Path):
+def get_tables(all_df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+    # one table per row type, with the columns that apply to that level
     region_df = all_df[all_df[row_type_col] == "Region"].drop(
         columns=[
             "Row Type",
@@ -396,39 +992,256 @@ def write_to_csv(all_df: pd.DataFrame, output_dir: Path):
         columns=["Row Type", "Source Format"]
     )
 
-    add_rows_to_file(output_dir / "region.csv", region_df)
-    add_rows_to_file(output_dir / "state.csv", state_df)
-    add_rows_to_file(output_dir / "sector.csv", sector_df)
-    add_rows_to_file(output_dir / "station_type.csv", station_type_df)
-    add_rows_to_file(output_dir / "station.csv", station_df)
-    add_rows_to_file(output_dir / "unit.csv", unit_df)
+    return {
+        "region": region_df,
+        "state": state_df,
+        "sector": sector_df,
+        "station_type": station_type_df,
+        "station": station_df,
+        "unit": unit_df,
+    }
+
+
+def write_to_csv(all_df: pd.DataFrame, output_dir: Path):
+    for table, df in get_tables(all_df).items():
+        add_rows_to_file(output_dir / f"{table}.csv", df)
+        metrics.incr(f"rows_written.csv.{table}", len(df))
+
+
+def write_to_parquet(all_df: pd.DataFrame, parquet_dir: Path):
+    import npp_parquet  # pyarrow is only needed for the parquet output
+
+    tables = get_tables(all_df)
+    npp_parquet.write_tables(tables, parquet_dir)
+    for table, df in tables.items():
+        metrics.incr(f"rows_written.parquet.{table}", len(df))
+
+
+def to_compact_result(df):
+    """
+    Transformed report as a dict of column arrays, None if it could not be parsed.
+    Only rows that end up in one of the output tables are kept, this keeps the result small
+    when it has to be pickled back from a worker process.
+    """
+    if df is None:
+        return None
+    df = df[df[row_type_col].notna()]
+    return {column: df[column].to_numpy() for column in df.columns}
+
 
+def transform_report(raw_report):
+    return to_compact_result(get_trnsformed_df(raw_report))
 
-def run():
+
+def transform_zip_member(zip_path, member):
+    return to_compact_result(get_zip_member_df(get_open_zip(zip_path), member))
+
+
+def timed_transform(transform, *args):
+    # runs in the worker, the time is sent back with the result and recorded by run
+    start = time.perf_counter()
+    result = transform(*args)
+    return result, time.perf_counter() - start
+
+
+def get_chunksize(no_of_reports, workers):
+    # a few chunks per worker, large enough to amortize the per task overhead of a process pool
+    return max(1, math.ceil(no_of_reports / (workers * 4)))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Parse NPP daily generation reports")
+    parser.add_argument(
+        "--executor",
+        choices=["thread", "process"],
+        default="thread",
+        help="process uses all cores, parsing is mostly GIL bound",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="number of workers, defaults to 40 threads or one process per core",
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="reports sent to a worker process at a time",
+    )
+    parser.add_argument(
+        "--output",
+        choices=["csv", "parquet"],
+        action="append",
+        help="output tables to write, can be repeated. Defaults to csv",
+    )
+    parser.add_argument(
+        "--csv-cache",
+        action="store_true",
+        help="extract the reports and keep the intermediate csv of each report, for debugging",
+    )
+    parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="parse reports again that failed in an earlier run, even if they did not change",
+    )
+    parser.add_argument(
+        "--include-pdf",
+        action="store_true",
+        help="also parse the pdf reports (up to 2018-03-31), needs java",
+    )
+    parser.add_argument(
+        "--pdf-workers",
+        type=int,
+        default=2,
+        help="worker processes for pdf reports, each keeps its own JVM running",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="dump cProfile stats of the run next to the metrics, worker processes are not profiled",
+    )
+    return parser.parse_args(args)
+
+
+def map_reports(executor_type, workers, chunksize, transform, tasks, total):
+    if executor_type == "process":
+        workers = workers or os.cpu_count()
+        chunksize = chunksize or get_chunksize(total, workers)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        workers = workers or 40
+        chunksize = 1
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    with executor:
+        # map keeps the results in the same order as the tasks
+        results = []
+        for result, seconds in tqdm(
+            executor.map(
+                functools.partial(timed_transform, transform),
+                *tasks,
+                chunksize=chunksize,
+            ),
+            total=total,
+        ):
+            metrics.observe("report_parse_s", seconds)
+            results.append(result)
+        return results
+
+
+def run(
+    executor_type="thread",
+    workers=None,
+    chunksize=None,
+    retry_failed=False,
+    csv_cache=False,
+    outputs=("csv",),
+    include_pdf=False,
+    pdf_workers=2,
+):
     # bulk process, useful when doing it for the first time. Else, download_reports already
     output_dir.mkdir(parents=True, exist_ok=True)
+    if include_pdf and importlib.util.find_spec("jpype") is None:
+        print(
+            "jpype is not installed, tabula will start a new JVM for every pdf report"
+        )
+    with metrics.timer("stage.plan_s"):
+        manifest = load_manifest()
+        recover_interrupted_write(manifest)
+        planned = plan_reports(manifest, retry_failed, include_pdf)
+        planned = dict(sorted(planned.items()))
+    for member in planned:
+        if csv_cache and member in manifest["reports"]:
+            # report changed upstream, the converted csv of the old bytes can't be reused
+            get_converted_csv_path(Path(member)).unlink(missing_ok=True)
+    print(f"Found {len(planned)} to convert")
+    if csv_cache:
+        paths = reports_to_parse(planned)
+        transform = transform_report
+    else:
+        paths = [src_dir / entry["zip"] for entry in planned.values()]
+        transform = transform_zip_member
+    members = list(planned)
+    is_pdf = [Path(member).suffix == ".pdf" for member in members]
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=40) as executor:
-        raw_reports = sorted(list(reports_to_parse()))
-        print(f"Found {len(raw_reports)} to convert")
-        results = list(tqdm(executor.map(get_trnsformed_df, raw_reports)))
+    results = [None] * len(members)
+    xls_indices = [i for i in range(len(members)) if not is_pdf[i]]
+    pdf_indices = [i for i in range(len(members)) if is_pdf[i]]
+    try:
+        for indices, executor_params in [
+            (xls_indices, (executor_type, workers, chunksize)),
+            # pdf reports always go to worker processes, tabula keeps one JVM per process
+            (pdf_indices, ("process", pdf_workers, None)),
+        ]:
+            if len(indices) == 0:
+                continue
+            tasks = [[paths[i] for i in indices]]
+            if not csv_cache:
+                tasks.append([members[i] for i in indices])
+            with metrics.timer("stage.parse_s"):
+                responses = map_reports(
+                    *executor_params, transform, tasks, len(indices)
+                )
+            for i, response in zip(indices, responses):
+                results[i] = response
+    finally:
+        # zips opened by thread workers, the next run may see them changed
+        close_open_zips()
 
-    executor.shutdown(wait=True)
     failed_dates = []
+    replaced_dates = []
     dfs = []
-    for idx, response in enumerate(results):
+    for (member, entry), response in zip(planned.items(), results):
+        previous = manifest["reports"].get(member)
         if response is None:
-            failed_dates.append(raw_reports[idx].stem)
+            failed_dates.append(Path(member).stem)
+            manifest["reports"][member] = {**entry, "status": "failed"}
+            metrics.incr("reports_failed")
         else:
-            dfs.append(response)
+            dfs.append(pd.DataFrame(response))
+            metrics.incr("reports_parsed")
+            metrics.incr("rows_parsed", len(dfs[-1]))
+            if previous is not None and previous["status"] == "parsed":
+                replaced_dates.append(entry["date"])
+            manifest["reports"][member] = {**entry, "status": "parsed"}
 
     if len(failed_dates) > 0:
         print(f"Failed to parse the following reports: {failed_dates}")
 
+    if len(replaced_dates) > 0 and "csv" in outputs:
+        # parquet partitions are rewritten per date, only the csv files need the old rows removed
+        print(f"Replacing rows of re-parsed reports: {replaced_dates}")
+        remove_dates_from_csv(output_dir, replaced_dates)
+
+    # the manifest is saved with the id of the run after the rows are written, an append log with the same
+    # id tells the next run whether the rows it records were all written
+    manifest["run"] = datetime.now().isoformat()
     if len(dfs) > 0:
         all_df = pd.concat(dfs, ignore_index=True)
-        write_to_csv(all_df, output_dir)
+        with metrics.timer("stage.write_s"):
+            if "csv" in outputs:
+                start_append(manifest["run"])
+                write_to_csv(all_df, output_dir)
+            if "parquet" in outputs:
+                write_to_parquet(all_df, parquet_dir)
+    save_manifest(manifest)
+    append_log_path.unlink(missing_ok=True)
 
 
 if __name__ == "__main__":
-    run()
+    args = parse_args()
+    metrics.start_run("parse_reports", metrics_dir, args.profile or None)
+    try:
+        run(
+            args.executor,
+            args.workers,
+            args.chunksize,
+            args.retry_failed,
+            args.csv_cache,
+            args.output or ["csv"],
+            args.include_pdf,
+            args.pdf_workers,
+        )
+    finally:
+        metrics.finish_run(args=vars(args))
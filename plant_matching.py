@@ -0,0 +1,451 @@
+"""
+Crosswalk between the MeritIndia plants (PowerStationName of daily-plant-generation) and the NPP stations
+(station.csv and unit.csv of the parsed reports). Only uses the standard library.
+
+* names are normalized (upper case, punctuation and generic words like POWER, STATION, LTD removed) and compared
+  by their core words (no type words like TPS, HPS and no stage numbers) and acronyms, MeritIndia often uses
+  acronyms (VSTPS for VINDHYACHAL STPS)
+* NPP stations are indexed by character trigrams per block, the block is (state, fuel) and (fuel) alone.
+  A plant is looked up in the block of its state first. MeritIndia lists the plants a state gets power from,
+  those in other states are looked up in the fuel block when the state block has no good match.
+  Only the stations that share the most trigrams with a plant are scored, not all the stations of a block
+* score = 0.8 * trigram dice of the closest aliases + 0.2 * idf weighted word overlap, a match needs min_score
+* the crosswalk is saved to data/plant-matching/crosswalk.csv with the best station and its score for every plant.
+  A run only reads the rows appended to the NPP csv files since the last run and only matches the plants that are
+  new, or that share a trigram with a new station of their block. The other plants keep their station, its score
+  is computed again with the idf of the current stations. A plant not matched again could in rare cases get
+  another station from --rebuild, which matches everything again
+* the NPP csv files are read from the offset of the last run, a file whose prefix hash changed (parse_reports
+  rewrites them when a report is parsed again) is read from the start
+
+    python plant_matching.py
+    python plant_matching.py --rebuild --min-score 0.7
+"""
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import math
+import re
+from collections import Counter
+from pathlib import Path
+
+from src.meritindia import metrics
+
+npp_csv_dir = Path("./data/npp/daily-generation/csv/")
+npp_files = ["station.csv", "unit.csv"]
+merit_dir = Path("./data/meritindia/daily-plant-generation/")
+state_codes_path = Path("./src/meritindia/state_codes.json")
+matching_dir = Path("./data/plant-matching/")
+metrics_dir = Path("./data/metrics/")
+min_score = 0.6
+# stations scored per plant, the ones sharing the most trigrams
+candidates_per_plant = 20
+stop_words = {"POWER", "STATION", "PROJECT", "PLANT", "LTD", "LIMITED", "PVT", "CO"}
+stop_words |= {"CORPORATION", "THE", "OF", "AND", "SHARE"}
+# words that say what kind of plant, whose or which part of it, not which plant
+type_words = {"TPS", "STPS", "TPP", "STPP", "HPS", "HEP", "HE", "GT", "GTP", "GPP"}
+type_words |= {"CCPP", "CCGT", "APS", "NPP", "HYDEL", "GAS", "LIQUID", "NAPM", "RLNG"}
+type_words |= {"NTPC", "NHPC", "NEEPCO", "NPCIL", "NTECL", "JV", "STAGE", "STG", "ST"}
+type_words |= {"UNIT", "EXT", "EXP", "EXPANSION", "ER", "WR", "NR", "SR", "NER"}
+numerals = {"I", "II", "III", "IV", "V", "VI", "VII", "VIII", "IX", "X"}
+# single words of a name (LOKTAK of LOKTAK, NHPC) count a bit less than all its core words
+token_alias_weight = 0.85
+fuels = {
+    "THERMAL": "THERMAL",
+    "COAL": "THERMAL",
+    "LIGNITE": "THERMAL",
+    "GAS": "THERMAL",
+    "DIESEL": "THERMAL",
+    "HYDRO": "HYDRO",
+    "NUCLEAR": "NUCLEAR",
+    "RENEWABLE": "RENEWABLE",
+}
+crosswalk_fields = [
+    "StateCode",
+    "PowerStationName",
+    "TypeOfGeneration",
+    "NPP State",
+    "NPP Station Type",
+    "NPP Station",
+    "score",
+    "block",
+    "status",
+]
+non_alnum_pattern = re.compile(r"[^A-Z0-9]+")
+letters_pattern = re.compile(r"\b[A-Z](?: [A-Z]\b)+")
+split_pattern = re.compile(r"([A-Z]{2,})([0-9]+)\b")
+
+
+def normalize(name: str) -> list[str]:
+    text = non_alnum_pattern.sub(" ", str(name).upper())
+    # "A P S" (A.P.S.) -> "APS", "KSTPS7" -> "KSTPS 7"
+    text = letters_pattern.sub(lambda match: match.group().replace(" ", ""), text)
+    text = split_pattern.sub(r"\1 \2", text)
+    return [token for token in text.split() if token not in stop_words]
+
+
+def is_core(token: str) -> bool:
+    return not (token in type_words or token in numerals or token.isdigit())
+
+
+def get_aliases(tokens: list[str]) -> list[tuple[str, float]]:
+    """
+    Texts a name is compared by, with their weight:
+
+    * the core words (no type words and numbers), KAHALGAON for KAHALGAON - I and KAHALGAON TPS, always first
+    * acronyms of the core words and the type word, VSTPS for VINDHYACHAL STPS, KAPS for KAKRAPAR A.P.S.
+    * single core words, LOKTAK for LOKTAK, NHPC
+    """
+    core = [token for token in tokens if is_core(token)]
+    aliases = [(" ".join(core), 1.0)]
+    kinds = [token for token in tokens if token in type_words]
+    initials = "".join(token[0] for token in core)
+    acronyms = [initials + kind for kind in kinds[:1]]
+    if len(core) >= 3:
+        acronyms.append(initials)
+    aliases += [(acronym, 1.0) for acronym in acronyms if len(acronym) >= 3]
+    if len(core) >= 2:
+        aliases += [(token, token_alias_weight) for token in core if len(token) >= 4]
+    return aliases
+
+
+def get_trigrams(text: str) -> set[str]:
+    text = f" {text} "
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+def get_fuel(type: str) -> str:
+    # first word of the type, "Thermal", "Coal", "Gas/Naptha", "HYDRO"
+    tokens = normalize(type)
+    return fuels.get(tokens[0] if tokens else "", "OTHER")
+
+
+def get_block(state: str, type: str) -> tuple[str, str]:
+    return " ".join(normalize(state)), get_fuel(type)
+
+
+def get_dice(a: set, b: set) -> float:
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 0.0
+
+
+class Name:
+    def __init__(self, name: str):
+        tokens = normalize(name)
+        self.aliases = [
+            (get_trigrams(text), weight) for text, weight in get_aliases(tokens)
+        ]
+        self.trigrams = set().union(*(trigrams for trigrams, _ in self.aliases))
+        # words for the overlap, numbers tell the stages of a plant apart
+        self.words = {token for token in tokens if token not in type_words}
+        self.words |= {text for text, _ in get_aliases(tokens)[1:]}
+
+
+class StationIndex:
+    """
+    Trigram index of the NPP stations per block: block -> trigram -> ids of the stations
+    """
+
+    def __init__(self, stations: list[tuple[str, str, str]]):
+        self.stations = stations
+        self.names = [Name(station) for _, _, station in stations]
+        self.blocks = {}
+        word_counts = Counter()
+        for id, ((state, type, _), name) in enumerate(zip(stations, self.names)):
+            state_block, fuel = get_block(state, type)
+            for block in [(state_block, fuel), ("", fuel)]:
+                postings = self.blocks.setdefault(block, {})
+                for trigram in name.trigrams:
+                    postings.setdefault(trigram, []).append(id)
+            word_counts.update(name.words)
+        # rare words (the actual names) count more than common ones (I, II)
+        self.idf = {
+            word: math.log((1 + len(stations)) / (1 + count)) + 1
+            for word, count in word_counts.items()
+        }
+        self.default_idf = math.log(1 + len(stations)) + 1
+
+    def score(self, name: Name, id: int) -> float:
+        # 0.8 * dice of the closest aliases + 0.2 * idf weighted overlap of the words
+        station = self.names[id]
+        # one side is the core words, two acronyms (SSTPS of SIPAT STPS and SIMHADRI STPS) say little
+        pairs = [(name.aliases[0], alias) for alias in station.aliases]
+        pairs += [(alias, station.aliases[0]) for alias in name.aliases[1:]]
+        dice = max(
+            min(weight_a, weight_b) * get_dice(trigrams_a, trigrams_b)
+            for (trigrams_a, weight_a), (trigrams_b, weight_b) in pairs
+        )
+        union = name.words | station.words
+        if not union:
+            return 0.8 * dice
+        weights = {word: self.idf.get(word, self.default_idf) for word in union}
+        overlap = sum(weights[word] for word in name.words & station.words)
+        return 0.8 * dice + 0.2 * overlap / sum(weights.values())
+
+    def lookup(self, name: Name, block: tuple[str, str]) -> tuple[int, float]:
+        # best station of the block for the name, (None, 0) when no station shares a trigram with it
+        postings = self.blocks.get(block)
+        if not postings:
+            return None, 0.0
+        shared = Counter()
+        for trigram in name.trigrams:
+            shared.update(postings.get(trigram, ()))
+        best_id, best_score = None, 0.0
+        # ties by id, the same stations give the same crosswalk
+        candidates = sorted(shared.items(), key=lambda item: (-item[1], item[0]))
+        for id, _ in candidates[:candidates_per_plant]:
+            score = self.score(name, id)
+            if score > best_score:
+                best_id, best_score = id, score
+        return best_id, best_score
+
+
+def match_plant(index: StationIndex, plant: dict, state_name: str) -> dict:
+    name = Name(plant["PowerStationName"])
+    state_block = get_block(state_name, plant["TypeOfGeneration"])
+    id, score = index.lookup(name, state_block)
+    block = "state"
+    if score < min_score:
+        fuel_id, fuel_score = index.lookup(name, ("", state_block[1]))
+        if fuel_score > score:
+            id, score, block = fuel_id, fuel_score, "fuel"
+    row = {
+        "StateCode": plant["StateCode"],
+        "PowerStationName": plant["PowerStationName"],
+        "TypeOfGeneration": plant["TypeOfGeneration"],
+        "NPP State": "",
+        "NPP Station Type": "",
+        "NPP Station": "",
+        "score": round(score, 4),
+        "block": "",
+        "status": "no_candidate",
+    }
+    if id is not None:
+        npp_state, npp_type, npp_station = index.stations[id]
+        row.update(
+            {
+                "NPP State": npp_state,
+                "NPP Station Type": npp_type,
+                "NPP Station": npp_station,
+                "block": block,
+                "status": "matched" if score >= min_score else "low_score",
+            }
+        )
+    return row
+
+
+def get_prefix_hash(path: Path, offset: int) -> str:
+    # hash of the bytes before offset, parse_reports rewrites the csv files when a report is parsed again
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        remaining = offset
+        while remaining > 0:
+            chunk = file.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def read_npp_stations(files: dict) -> set[tuple[str, str, str]]:
+    """
+    (State, Station Type, Station) of the rows appended to the NPP csv files since the last run.
+    files has the offset up to which a file was read and the hash of the bytes before it, it is updated.
+    A file whose size or prefix hash does not match was rewritten and is read from the start.
+    """
+    stations = set()
+    for file_name in npp_files:
+        path = npp_csv_dir / file_name
+        if not path.exists():
+            continue
+        offset = files.get(file_name, {}).get("offset", 0)
+        if path.stat().st_size < offset or (
+            offset > 0 and get_prefix_hash(path, offset) != files[file_name]["hash"]
+        ):
+            print(f"{path} was rewritten, reading all of it")
+            offset = 0
+        with open(path, "rb") as file:
+            header_line = file.readline()
+            if not header_line.endswith(b"\n"):
+                continue
+            offset = max(offset, len(header_line))
+            file.seek(offset)
+            data = file.read()
+        # a line being written is read in the next run
+        data = data[: data.rfind(b"\n") + 1]
+        offset += len(data)
+        files[file_name] = {"offset": offset, "hash": get_prefix_hash(path, offset)}
+        header = next(csv.reader([header_line.decode()]))
+        rows = csv.DictReader(io.StringIO(data.decode(), newline=""), header)
+        for row in rows:
+            if row.get("Station"):
+                stations.add((row["State"], row["Station Type"], row["Station"]))
+    return stations
+
+
+def read_merit_plants() -> list[dict]:
+    # plants of the catalog (see plant_catalog), the raw files when there is no catalog
+    catalog_path = merit_dir / "catalog.csv"
+    if catalog_path.exists():
+        paths = [catalog_path]
+    else:
+        paths = sorted((merit_dir / "raw").glob("*.csv"))
+    plants = {}
+    for path in paths:
+        with open(path, "r", newline="") as file:
+            for row in csv.DictReader(file):
+                key = (row["StateCode"], row["PowerStationName"])
+                plants[key] = {
+                    "StateCode": row["StateCode"],
+                    "PowerStationName": row["PowerStationName"],
+                    "TypeOfGeneration": row["TypeOfGeneration"],
+                }
+    return list(plants.values())
+
+
+def read_csv(path: Path) -> list[dict]:
+    if not path.exists():
+        return []
+    with open(path, "r", newline="") as file:
+        return list(csv.DictReader(file))
+
+
+def write_csv(path: Path, fields: list[str], rows: list[dict]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "w", newline="") as file:
+        csv_writer = csv.DictWriter(file, fieldnames=fields)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+    temp_path.replace(path)
+
+
+def rescore(index: StationIndex, crosswalk: dict, matched: set):
+    """
+    Scores the kept rows of the crosswalk (plants not in matched) against their station again.
+    The idf of the words changes with new stations, the scores and statuses stay those of the current index.
+    """
+    ids = {station: id for id, station in enumerate(index.stations)}
+    for key, row in crosswalk.items():
+        station = (row["NPP State"], row["NPP Station Type"], row["NPP Station"])
+        if key in matched or station not in ids:
+            continue
+        score = index.score(Name(row["PowerStationName"]), ids[station])
+        row["score"] = round(score, 4)
+        row["status"] = "matched" if score >= min_score else "low_score"
+
+
+def run(rebuild=False):
+    state_path = matching_dir / "state.json"
+    stations_path = matching_dir / "npp_stations.csv"
+    crosswalk_path = matching_dir / "crosswalk.csv"
+    state = {"files": {}}
+    known_stations = set()
+    crosswalk = {}
+    if not rebuild and state_path.exists():
+        with open(state_path, "r") as file:
+            state = json.load(file)
+        if "files" not in state:
+            # offsets without hashes (older version), the files are read again
+            state = {"files": {}}
+        known_stations = {
+            (row["State"], row["Station Type"], row["Station"])
+            for row in read_csv(stations_path)
+        }
+        crosswalk = {
+            (row["StateCode"], row["PowerStationName"]): row
+            for row in read_csv(crosswalk_path)
+        }
+
+    with metrics.timer("stage.read_s"):
+        new_stations = read_npp_stations(state["files"]) - known_stations
+        stations = sorted(known_stations | new_stations)
+        plants = read_merit_plants()
+        with open(state_codes_path, "r") as file:
+            state_names = json.load(file)
+    print(f"{len(stations)} NPP stations, {len(new_stations)} new")
+
+    # trigrams of the new stations per block, only plants of the block that share one of them
+    # (and were matched in it, or not matched) can get a better match
+    new_trigrams = {}
+    for npp_state, type, station in new_stations:
+        state_block, fuel = get_block(npp_state, type)
+        for block in [(state_block, fuel), ("", fuel)]:
+            new_trigrams.setdefault(block, set()).update(Name(station).trigrams)
+    to_match = []
+    for plant in plants:
+        key = (plant["StateCode"], plant["PowerStationName"])
+        state_block, fuel = get_block(
+            state_names.get(plant["StateCode"], plant["StateCode"]),
+            plant["TypeOfGeneration"],
+        )
+        previous = crosswalk.get(key)
+        if previous is None:
+            to_match.append(plant)
+            continue
+        trigrams = Name(plant["PowerStationName"]).trigrams
+        if not trigrams.isdisjoint(new_trigrams.get((state_block, fuel), ())) or (
+            previous["block"] != "state"
+            and not trigrams.isdisjoint(new_trigrams.get(("", fuel), ()))
+        ):
+            to_match.append(plant)
+    print(f"{len(plants)} MeritIndia plants, {len(to_match)} to match")
+
+    with metrics.timer("stage.match_s"):
+        index = StationIndex(stations)
+        for plant in to_match:
+            state_name = state_names.get(plant["StateCode"], plant["StateCode"])
+            row = match_plant(index, plant, state_name)
+            crosswalk[(plant["StateCode"], plant["PowerStationName"])] = row
+        rescore(
+            index,
+            crosswalk,
+            {(plant["StateCode"], plant["PowerStationName"]) for plant in to_match},
+        )
+    metrics.incr("plants_matched", len(to_match))
+    statuses = Counter(row["status"] for row in crosswalk.values())
+    for status, count in statuses.items():
+        metrics.set_gauge(f"crosswalk.{status}", count)
+    print(f"Crosswalk: {dict(statuses)}")
+
+    write_csv(
+        stations_path,
+        ["State", "Station Type", "Station"],
+        [
+            {"State": npp_state, "Station Type": type, "Station": station}
+            for npp_state, type, station in stations
+        ],
+    )
+    write_csv(
+        crosswalk_path,
+        crosswalk_fields,
+        [crosswalk[key] for key in sorted(crosswalk)],
+    )
+    # state last, a run stopped before this reads the same rows again
+    with open(state_path, "w") as file:
+        json.dump(state, file, indent=4)
+    print(f"Crosswalk written to {crosswalk_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Match MeritIndia plants to NPP stations"
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true", help="match all the plants again"
+    )
+    parser.add_argument(
+        "--min-score",
+        type=float,
+        default=min_score,
+        help="score a plant needs to be matched, applies to all the plants of the crosswalk",
+    )
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+    min_score = args.min_score
+    metrics.start_run("plant_matching", metrics_dir, profile=args.profile or None)
+    run(args.rebuild)
+    metrics.finish_run(args=vars(args))
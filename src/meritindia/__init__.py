@@ -0,0 +1,4 @@
+"""
+Scripts of the meritindia workflows and the lambda function. They run from this directory and import each other
+by module name, the scripts at the root of the repo import the standalone ones as src.meritindia.<module>.
+"""
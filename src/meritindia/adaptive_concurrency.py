@@ -0,0 +1,169 @@
+"""
+Adaptive concurrency (AIMD) for the meritindia requests of daily_generation_helper and current_generation_helper.
+* additive increase: every request that completes within latency_target adds 1 / limit, about +1 per round of requests
+* multiplicative decrease: a timeout, connection error or 5xx multiplies the limit by decrease_factor,
+  at most once per latency_target seconds so one burst of failures only backs off once
+* requests that failed that way are sent again, up to max_attempts, other errors are raised.
+  A retry waits retry_delay seconds (doubled for every further attempt, with jitter) without holding a slot,
+  other inputs are sent meanwhile. This is the only layer that sends a request again, the session (merit_session)
+  only retries connection setup and GET requests. With max_attempts=2, the 55s request timeout of merit_session
+  and at most 2s before the retry an input takes at most 112s, within the 120s proxy timeout
+* max_limit defaults to 10, the fixed pool size it replaced. The proxy client splits it over its batches in flight
+  (daily_generation.py sends max_concurrency), so the requests to meritindia stay around 10 in total
+The limit is kept between calls (and warm lambda invocations) by keeping the controller at module level.
+"""
+
+import concurrent.futures
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import requests
+
+import metrics
+
+# seconds before the first retry of an input
+retry_delay = 2.0
+
+
+class AimdController:
+    def __init__(
+        self,
+        initial: int,
+        min_limit: int = 1,
+        max_limit: int = 10,
+        latency_target: float = 5.0,
+        decrease_factor: float = 0.5,
+    ):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.lock = threading.Lock()
+        self.last_decrease = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"start": self.current, "min": self.current, "max": self.current}
+
+    @property
+    def current(self) -> int:
+        return int(self.limit)
+
+    def record(self):
+        self.stats["min"] = min(self.stats["min"], self.current)
+        self.stats["max"] = max(self.stats["max"], self.current)
+        metrics.observe("concurrency", self.current)
+
+    def on_success(self, latency: float):
+        with self.lock:
+            if latency <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.record()
+
+    def on_congestion(self):
+        with self.lock:
+            now = time.monotonic()
+            if (
+                self.last_decrease is None
+                or now - self.last_decrease >= self.latency_target
+            ):
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self.last_decrease = now
+                metrics.incr("concurrency_decreases")
+            self.record()
+
+    def set_max_limit(self, max_limit: int):
+        with self.lock:
+            self.max_limit = max(self.min_limit, max_limit)
+            self.limit = min(self.limit, self.max_limit)
+
+    def summary(self) -> dict:
+        return {**self.stats, "end": self.current}
+
+
+def is_congestion_error(error: Exception) -> bool:
+    if isinstance(
+        error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+    ):
+        return True
+    return (
+        isinstance(error, requests.exceptions.HTTPError)
+        and error.response is not None
+        and error.response.status_code >= 500
+    )
+
+
+def timed_call(func, args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def get_retry_delay(attempt: int, delay: float) -> float:
+    # delay before sending an input for the attempt after attempt, between half and all of the backoff
+    return delay * 2 ** (attempt - 1) * random.uniform(0.5, 1)
+
+
+def map_adaptive(
+    func,
+    inputs,
+    controller: AimdController,
+    max_attempts: int = 2,
+    delay: float = retry_delay,
+):
+    """
+    Calls func(*input) for every input with at most controller.current calls running at a time.
+    Yields the results as they complete, not in the order of the inputs.
+    Inputs are taken from the iterable as calls complete, a generator of inputs is not read ahead.
+    """
+    inputs = iter(inputs)
+    # (time the retry is due, order, input, attempt), the order keeps inputs from being compared
+    retries = []
+    order = itertools.count()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=controller.max_limit
+    ) as executor:
+        futures = {}
+        while True:
+            while len(futures) < controller.current:
+                if retries and retries[0][0] <= time.monotonic():
+                    _, _, input, attempt = heapq.heappop(retries)
+                else:
+                    input = next(inputs, None)
+                    if input is None:
+                        break
+                    attempt = 1
+                futures[executor.submit(timed_call, func, input)] = (input, attempt)
+            # with a free slot, wake up when the next retry is due
+            timeout = None
+            if retries and len(futures) < controller.current:
+                timeout = max(0, retries[0][0] - time.monotonic())
+            if not futures:
+                if not retries:
+                    break
+                time.sleep(timeout)
+                continue
+            done, _ = concurrent.futures.wait(
+                futures, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                input, attempt = futures.pop(future)
+                try:
+                    result, latency = future.result()
+                except Exception as e:
+                    if not is_congestion_error(e):
+                        raise
+                    controller.on_congestion()
+                    if attempt >= max_attempts:
+                        raise
+                    retry_at = time.monotonic() + get_retry_delay(attempt, delay)
+                    print(f"Retrying {input} after {e}")
+                    metrics.incr("retries")
+                    heapq.heappush(retries, (retry_at, next(order), input, attempt + 1))
+                    continue
+                controller.on_success(latency)
+                yield result
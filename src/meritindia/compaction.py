@@ -0,0 +1,241 @@
+"""
+Compaction of the daily state files (<data type>/raw/<StateCode>.csv). The raw files are an append log, rows of
+a run are in the order the requests completed. Compaction merges the rows appended since the last compaction into
+segments sorted by date, one per state and year, gzipped: <data type>/compacted/<StateCode>/<year>-<generation>.csv.gz
+
+* <data type>/compacted/manifest.json has, per state, the byte offset of the raw file up to which rows are in the
+  segments, a hash of the raw file before that offset and the segments of every year (file, rows, first and last date).
+  The size and modification time of the raw file are saved with the hash, it is only computed again when they change
+* only the rows after the offset are read from a raw file, and only the segments of the years they fall in are rewritten
+* a rewritten segment gets a new generation, the manifest is replaced after the segments are written and then
+  the old segments are deleted. A compaction stopped in between leaves the manifest and its segments as they were
+* the raw files are kept as they are, other scripts read them (dedup_index, plant_catalog, plant_matching).
+  The segments are a local copy for faster reads, not committed (see .gitignore), and built again from the raw files
+  in a fresh clone
+* a raw file that got shorter than its offset, or whose bytes before the offset changed, is compacted again from the start
+* read_rows reads a state (and year) from the segments of the manifest plus the rows after the offset in the raw file
+
+    python compaction.py compact daily-plant-generation
+    python compaction.py read daily-plant-generation GJT --year 2023
+"""
+
+import argparse
+import csv
+import gzip
+import hashlib
+import io
+import json
+from pathlib import Path
+
+data_dir = Path("../../data/meritindia/")
+sort_fields = ["DateTime", "PowerStationName"]
+
+
+def get_dirs(data_type, base_dir: Path = None) -> tuple[Path, Path]:
+    type_dir = Path(base_dir or data_dir) / data_type
+    return type_dir / "raw", type_dir / "compacted"
+
+
+def load_manifest(compacted_dir: Path) -> dict:
+    manifest_path = compacted_dir / "manifest.json"
+    if not manifest_path.exists():
+        return {"states": {}}
+    with open(manifest_path, "r") as file:
+        return json.load(file)
+
+
+def save_manifest(compacted_dir: Path, manifest: dict):
+    compacted_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = compacted_dir / "manifest.json"
+    temp_path = manifest_path.with_suffix(".tmp")
+    with open(temp_path, "w") as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+    temp_path.replace(manifest_path)
+
+
+def read_tail(raw_path: Path, offset: int) -> tuple[list[str], list[dict], int]:
+    """
+    Header and rows of the raw file after offset, up to the last complete line.
+    Returns the header, the rows and the offset after them.
+    """
+    with open(raw_path, "rb") as file:
+        header_line = file.readline()
+        if not header_line.endswith(b"\n"):
+            return [], [], offset
+        file.seek(max(offset, len(header_line)))
+        data = file.read()
+    # a line being written (or cut by a stopped run) is left for the next compaction
+    data = data[: data.rfind(b"\n") + 1]
+    header = next(csv.reader([header_line.decode()]))
+    rows = list(csv.DictReader(io.StringIO(data.decode(), newline=""), header))
+    return header, rows, max(offset, len(header_line)) + len(data)
+
+
+def get_prefix_hash(raw_path: Path, offset: int) -> str:
+    # hash of the bytes before offset, the rows in the segments came from them
+    digest = hashlib.blake2b(digest_size=16)
+    with open(raw_path, "rb") as file:
+        remaining = offset
+        while remaining > 0:
+            chunk = file.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            digest.update(chunk)
+            remaining -= len(chunk)
+    return digest.hexdigest()
+
+
+def get_file_stat(raw_path: Path) -> dict:
+    # size and modification time saved with the prefix hash, taken before the file is read
+    stat = raw_path.stat()
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def is_prefix_unchanged(raw_path: Path, state: dict) -> bool:
+    """
+    The raw file still starts with the bytes that were compacted into the segments of state.
+    The prefix is only hashed when the size or modification time of the file changed since the hash was saved.
+    """
+    offset = state.get("offset", 0)
+    if offset == 0:
+        return True
+    stat = get_file_stat(raw_path)
+    if stat["size"] < offset:
+        return False
+    if all(state.get(key) == value for key, value in stat.items()):
+        return True
+    return state.get("prefix_hash") == get_prefix_hash(raw_path, offset)
+
+
+def get_sort_key(row: dict) -> tuple:
+    return tuple(row.get(field) or "" for field in sort_fields)
+
+
+def read_segment(path: Path) -> list[dict]:
+    with gzip.open(path, "rt", newline="") as file:
+        return list(csv.DictReader(file))
+
+
+def write_segment(path: Path, header: list[str], rows: list[dict]):
+    buffer = io.StringIO(newline="")
+    csv_writer = csv.DictWriter(buffer, fieldnames=header)
+    csv_writer.writeheader()
+    csv_writer.writerows(rows)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # mtime=0, the same rows give the same file
+    with open(path, "wb") as file:
+        file.write(gzip.compress(buffer.getvalue().encode(), mtime=0))
+
+
+def get_next_generation(state_dir: Path, year) -> int:
+    # higher than any segment of the year on disk, a new segment never overwrites one the manifest may point to
+    generations = [
+        int(path.name[len(year) + 1 : -len(".csv.gz")])
+        for path in state_dir.glob(f"{year}-*.csv.gz")
+    ]
+    return max(generations, default=-1) + 1
+
+
+def compact_state(raw_path: Path, compacted_dir: Path, state: dict):
+    """
+    Merges the rows appended to raw_path since the last compaction into the segments of their years,
+    updates state (the manifest entry of the state)
+    """
+    state_code = raw_path.stem
+    if not is_prefix_unchanged(raw_path, state):
+        print(f"{raw_path} changed before its compacted offset, compacting it again")
+        state.clear()
+    state.setdefault("offset", 0)
+    state.setdefault("segments", {})
+    stat = get_file_stat(raw_path)
+    header, rows, offset = read_tail(raw_path, state["offset"])
+    rows_by_year = {}
+    for row in rows:
+        rows_by_year.setdefault(row["DateTime"][:4], []).append(row)
+    for year, year_rows in sorted(rows_by_year.items()):
+        segment = state["segments"].get(year)
+        if segment is not None:
+            year_rows = read_segment(compacted_dir / segment["file"]) + year_rows
+        # stable sort, rows of the same date and plant stay in the order they were fetched
+        year_rows.sort(key=get_sort_key)
+        generation = get_next_generation(compacted_dir / state_code, year)
+        file_name = f"{state_code}/{year}-{generation}.csv.gz"
+        write_segment(compacted_dir / file_name, header, year_rows)
+        state["segments"][year] = {
+            "file": file_name,
+            "rows": len(year_rows),
+            "first_date": year_rows[0]["DateTime"],
+            "last_date": year_rows[-1]["DateTime"],
+        }
+    state["offset"] = offset
+    state["prefix_hash"] = get_prefix_hash(raw_path, offset)
+    state.update(stat)
+    print(f"{len(rows)} rows of {state_code} compacted")
+
+
+def compact(data_type, base_dir: Path = None):
+    raw_dir, compacted_dir = get_dirs(data_type, base_dir)
+    manifest = load_manifest(compacted_dir)
+    manifest["data_type"] = data_type
+    for raw_path in sorted(raw_dir.glob("*.csv")):
+        state = manifest["states"].setdefault(raw_path.stem, {})
+        compact_state(raw_path, compacted_dir, state)
+    save_manifest(compacted_dir, manifest)
+    # segments that were rewritten, or written by a compaction stopped before its manifest was saved
+    for state_code, state in manifest["states"].items():
+        files = {segment["file"] for segment in state["segments"].values()}
+        for path in (compacted_dir / state_code).glob("*.csv.gz"):
+            if f"{state_code}/{path.name}" not in files:
+                path.unlink()
+
+
+def read_rows(data_type, state_code, year: str = None, base_dir: Path = None):
+    """
+    Rows of a state (all years or one), sorted by date. Reads the segments of the manifest
+    and the rows of the raw file that were not compacted yet.
+    """
+    raw_dir, compacted_dir = get_dirs(data_type, base_dir)
+    state = load_manifest(compacted_dir)["states"].get(state_code, {})
+    raw_path = raw_dir / f"{state_code}.csv"
+    if raw_path.exists() and not is_prefix_unchanged(raw_path, state):
+        # the segments do not match the raw file anymore
+        state = {}
+    rows = []
+    for segment_year, segment in sorted(state.get("segments", {}).items()):
+        if year is None or segment_year == year:
+            rows += read_segment(compacted_dir / segment["file"])
+    if raw_path.exists():
+        _, tail_rows, _ = read_tail(raw_path, state.get("offset", 0))
+        tail_rows = [
+            row for row in tail_rows if year is None or row["DateTime"][:4] == year
+        ]
+        if tail_rows:
+            rows = sorted(rows + tail_rows, key=get_sort_key)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compaction of the daily state files")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compact_parser = subparsers.add_parser("compact")
+    compact_parser.add_argument(
+        "data_type", choices=["daily-state-generation", "daily-plant-generation"]
+    )
+    read_parser = subparsers.add_parser("read", help="print the rows of a state as csv")
+    read_parser.add_argument(
+        "data_type", choices=["daily-state-generation", "daily-plant-generation"]
+    )
+    read_parser.add_argument("state_code")
+    read_parser.add_argument("--year")
+    parser.add_argument("--data-dir", type=Path, default=data_dir)
+    args = parser.parse_args()
+    if args.command == "compact":
+        compact(args.data_type, args.data_dir)
+    else:
+        import sys
+
+        rows = read_rows(args.data_type, args.state_code, args.year, args.data_dir)
+        if rows:
+            csv_writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+            csv_writer.writeheader()
+            csv_writer.writerows(rows)
@@ -4,10 +4,15 @@ import requests
 from pathlib import Path
 
 import current_generation_helper as cgh
+import metrics
+import response_format
 
 output_dir = Path("../../data/meritindia/current-generation/raw")
+metrics_dir = Path("../../data/metrics")
 proxy_url = os.getenv("PROXY_URL")
 # using a proxy since the meritindia API is only accessible from India IPs
+# rows, columnar or columnar-gzip, see response_format
+format = os.getenv("RESPONSE_FORMAT", "rows")
 
 type = sys.argv[1]
 
@@ -18,15 +23,24 @@ elif type == "india":
     req_body = {"type": "current-india-generation"}
     saver = cgh.save_india_data
 
-res = requests.request(
-    "POST",
-    proxy_url,
-    json=req_body,
-    timeout=120,
-)
+if format != "rows":
+    req_body["format"] = format
+
+metrics.start_run(f"current_generation-{type}", metrics_dir)
+with metrics.timer("proxy_latency_s"):
+    res = requests.request(
+        "POST",
+        proxy_url,
+        json=req_body,
+        timeout=120,
+    )
+metrics.incr("bytes_fetched", len(res.content))
 try:
-    rows = res.json()["data"]
+    body = res.json()
+    rows = response_format.decode_rows(body["data"])
+    metrics.record_remote_run(body.get("metrics"))
 except Exception as e:
     print(f"Failed to fetch {type} data", e)
     print(res.text)
 saver(rows, output_dir)
+metrics.finish_run()
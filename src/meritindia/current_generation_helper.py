@@ -1,10 +1,14 @@
 import requests
+import functools
 import json
 from pathlib import Path
 from datetime import datetime
 import pytz
 import csv
-import concurrent.futures
+
+import metrics
+from adaptive_concurrency import AimdController, map_adaptive
+from merit_session import get_session
 
 requests.packages.urllib3.disable_warnings()
 # to disable the ssl verify warning
@@ -17,18 +21,24 @@ india_url = f"https://{ip}/Dashboard/BindAllIndiaMap"
 state_codes_path = Path("./state_codes.json")
 
 timezone = "Asia/Kolkata"
+# number of parallel requests, adjusted to the latency and errors of the meritindia server
+concurrency = AimdController(initial=10)
 
 
+@functools.cache
 def load_state_codes():
+    # read once per process, warm lambda invocations reuse it. Callers must not modify it
     with open(state_codes_path, "r") as file:
         state_codes = json.load(file)
     return state_codes
 
 
 def request_current_data_india() -> str:
-    response = requests.request(
-        "GET", india_url, verify=False, timeout=60, headers={"Host": domain}
-    )
+    with metrics.timer("http_latency_s"):
+        response = get_session(concurrency.max_limit).get(
+            india_url, verify=False, headers={"Host": domain}
+        )
+    metrics.incr("bytes_fetched", len(response.content))
     return response.text
 
 
@@ -57,13 +67,15 @@ def get_india_row():
 
 
 def request_current_state_data(state_code):
-    response = requests.post(
-        url,
-        data={"StateCode": state_code},
-        verify=False,
-        headers={"Host": domain},
-        timeout=60,
-    )
+    with metrics.timer("http_latency_s"):
+        response = get_session(concurrency.max_limit).post(
+            url,
+            data={"StateCode": state_code},
+            verify=False,
+            headers={"Host": domain},
+        )
+    metrics.incr("bytes_fetched", len(response.content))
+    response.raise_for_status()
     data = response.json()
     assert (
         len(data) == 1
@@ -89,6 +101,7 @@ def save_state_data(rows, dest_dir):
             csv_writer.writeheader()
 
         csv_writer.writerows(rows)
+    metrics.incr("rows_written", len(rows))
     print(f"Data written to {output_file}")
 
 
@@ -114,6 +127,7 @@ def save_india_data(row, dest_dir):
             csv_writer.writeheader()
 
         csv_writer.writerow(row)
+    metrics.incr("rows_written")
     print(f"Data written to {output_file}")
 
 
@@ -121,12 +135,10 @@ def get_data():
     state_codes = load_state_codes()
     rows = []
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        futures = []
-        for code, name in state_codes.items():
-            futures.append(executor.submit(request_current_state_data, code))
-
-        for future in concurrent.futures.as_completed(futures):
-            row = future.result()
-            rows.append(row)
+    concurrency.reset_stats()
+    inputs = [(code,) for code in state_codes]
+    for row in map_adaptive(request_current_state_data, inputs, concurrency):
+        rows.append(row)
+    print("Concurrency:", concurrency.summary())
+    metrics.set_gauge("concurrency", concurrency.current)
     return rows
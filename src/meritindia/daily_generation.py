@@ -1,40 +1,148 @@
-import sys
+import argparse
 import json
 import os
+import time
 import requests
+import concurrent.futures
+from collections import deque
 from pathlib import Path
 
 import daily_generation_helper as dgh
+import metrics
+import response_format
 
+metrics_dir = Path("../../data/metrics")
 proxy_url = os.getenv("PROXY_URL")
 # using a proxy since the meritindia API is only accessible from India IPs
 
-data_type = sys.argv[1]
-
-assert data_type in [
-    "daily-state-generation",
-    "daily-plant-generation",
-], f"Unknown type: {data_type}"
-
-request_inputs = list(dgh.get_request_inputs(data_type))
-assert len(request_inputs) < 500, "Too many inputs"
-
-if request_inputs:
-    batch_size = 20
-    num_batches = (len(request_inputs) + batch_size - 1) // batch_size
-
-    for i in range(num_batches):
-        batch_inputs = request_inputs[i * batch_size : (i + 1) * batch_size]
-        req_body = {"type": data_type, "inputs": batch_inputs}
-        print(json.dumps(req_body))
-        res = requests.request("POST", proxy_url, json=req_body, timeout=120)
-        try:
-            rows = res.json()["data"]
-        except Exception:
-            print(f"Failed to fetch data for {req_body}")
-            print(res.text)
-            raise Exception("Failed to fetch data")
-        dgh.save_data(data_type, rows)
-        dgh.update_tracking_metadata(data_type, rows)
-else:
-    print("Nothing to get")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Fetch daily generation via the proxy")
+    parser.add_argument(
+        "data_type", choices=["daily-state-generation", "daily-plant-generation"]
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=20, help="inputs sent in one proxy request"
+    )
+    parser.add_argument(
+        "--inflight",
+        type=int,
+        default=3,
+        help="proxy requests in flight at a time, they share dgh.max_workers requests to meritindia",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=30,
+        help="minutes, no new batches are sent after this. The rest is fetched in the next run",
+    )
+    parser.add_argument(
+        "--compact-storage",
+        action="store_true",
+        help="also write plant rows with plant ids and numeric values, see plant_catalog",
+    )
+    parser.add_argument(
+        "--response-format",
+        choices=response_format.formats,
+        default="rows",
+        help="format of the proxy responses, the compact formats let bigger batches fit in a response",
+    )
+    return parser.parse_args()
+
+
+def post_batch(
+    session: requests.Session, data_type, batch_inputs, format="rows", inflight=1
+):
+    # the batches in flight share dgh.max_workers requests to meritindia
+    req_body = {
+        "type": data_type,
+        "inputs": batch_inputs,
+        "max_concurrency": max(1, dgh.max_workers // inflight),
+    }
+    if format != "rows":
+        # older deployments of the lambda ignore it and return rows, decode_rows handles both
+        req_body["format"] = format
+    print(json.dumps(req_body))
+    with metrics.timer("proxy_latency_s"):
+        res = session.post(proxy_url, json=req_body, timeout=120)
+    metrics.incr("bytes_fetched", len(res.content))
+    try:
+        body = res.json()
+        rows = response_format.decode_rows(body["data"])
+    except Exception:
+        print(f"Failed to fetch data for {req_body}")
+        print(res.text)
+        raise Exception("Failed to fetch data")
+    metrics.record_remote_run(body.get("metrics"))
+    return rows
+
+
+def fetch_pipelined(
+    data_type, request_inputs, batch_size, inflight, time_budget, format="rows"
+):
+    """
+    Keeps up to inflight batches in flight to the proxy and writes the results in the order of the batches,
+    so the tracking data never moves past a batch that was not written.
+    New batches are only sent within time_budget seconds, batches in flight when it runs out are still written.
+    Returns the number of inputs that were not sent.
+    """
+    batches = deque(
+        request_inputs[i : i + batch_size]
+        for i in range(0, len(request_inputs), batch_size)
+    )
+    deadline = time.monotonic() + time_budget
+    # state files stay open for the whole run instead of being reopened for every batch
+    writers = dgh.StateCsvWriters(data_type)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=inflight)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=inflight)
+    in_flight = deque()
+    try:
+        while batches or in_flight:
+            while batches and len(in_flight) < inflight:
+                if time.monotonic() >= deadline:
+                    print("Time budget used up, not sending more batches")
+                    break
+                batch_inputs = batches.popleft()
+                in_flight.append(
+                    executor.submit(
+                        post_batch, session, data_type, batch_inputs, format, inflight
+                    )
+                )
+            if not in_flight:
+                break
+            rows = in_flight.popleft().result()
+            metrics.incr("rows_fetched", len(rows))
+            writers.write(rows)
+            for state_code, date in dgh.get_latest_dates(rows).items():
+                writers.mark_fetched(state_code, date)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        writers.close()
+        dgh.close_tracking_store(data_type)
+    return sum(len(batch) for batch in batches)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    metrics.start_run(f"daily_generation-{args.data_type}", metrics_dir)
+    dgh.compact_plant_storage = args.compact_storage
+    request_inputs = list(dgh.get_request_inputs(args.data_type))
+
+    if request_inputs:
+        remaining = fetch_pipelined(
+            args.data_type,
+            request_inputs,
+            args.batch_size,
+            args.inflight,
+            args.time_budget * 60,
+            args.response_format,
+        )
+        if remaining > 0:
+            print(f"{remaining} inputs left for the next run")
+        metrics.incr("inputs_remaining", remaining)
+    else:
+        print("Nothing to get")
+    metrics.finish_run(requests=len(request_inputs), args=vars(args))
@@ -1,12 +1,19 @@
+import argparse
 import requests
+import functools
 import json
 import csv
+import time
+from collections import deque
 from datetime import datetime, timedelta
 import pytz
 from pathlib import Path
-import concurrent.futures
 from typing import Iterable
 
+from adaptive_concurrency import AimdController, map_adaptive
+from merit_session import get_session
+import metrics
+
 requests.packages.urllib3.disable_warnings()
 # to disable the ssl verify warning
 
@@ -22,31 +29,86 @@ state_codes_path = Path("./state_codes.json")
 output_dir = Path("../../data/meritindia/")
 max_workers = 10
 batch_size = 100  # how often to save the data to disk
+flush_interval = 5  # seconds, how often the streaming writers flush to disk
+tracking_stores = {}
+key_indexes = {}
+plant_catalogs = {}
+# also write the plant rows to compact/<state>.csv with plant ids, see plant_catalog
+compact_plant_storage = False
+# number of parallel requests, adjusted to the latency and errors of the meritindia server
+concurrency = AimdController(initial=max_workers, max_limit=max_workers)
 
 
 def get_track_path(data_type):
     return tracking_base_path / f"{data_type}.json"
 
 
+def get_tracking_store(data_type):
+    # the writer modules are imported only when needed, the lambda function only fetches
+    from tracking_store import TrackingStore
+
+    if data_type not in tracking_stores:
+        tracking_stores[data_type] = TrackingStore(get_track_path(data_type))
+    return tracking_stores[data_type]
+
+
+def get_key_index(data_type):
+    # keys of the rows in the state files, for skipping rows that were already written
+    from dedup_index import KeyIndex
+
+    if data_type not in key_indexes:
+        key_indexes[data_type] = KeyIndex(data_type, output_dir)
+    return key_indexes[data_type]
+
+
+def get_plant_catalog():
+    import plant_catalog
+
+    base_dir = output_dir / "daily-plant-generation"
+    if base_dir not in plant_catalogs:
+        plant_catalogs[base_dir] = plant_catalog.PlantCatalog(base_dir / "catalog.csv")
+    return plant_catalogs[base_dir]
+
+
+def save_plant_rows(rows_by_state: dict[str, list[dict]]):
+    """
+    Plants of the rows go to the catalog, the rows to the compact storage if it is enabled.
+    Called once the rows are in the raw files. The catalog is saved once, before compact rows refer to its plants
+    """
+    import plant_catalog
+
+    catalog = get_plant_catalog()
+    compact_rows = {}
+    for state_code, rows in rows_by_state.items():
+        if compact_plant_storage:
+            compact_rows[state_code] = plant_catalog.encode_rows(catalog, rows)
+        else:
+            catalog.add(rows)
+    catalog.save()
+    for state_code, rows in compact_rows.items():
+        plant_catalog.write_compact(
+            state_code, rows, output_dir / "daily-plant-generation"
+        )
+
+
 def load_tracking_data(data_type):
-    tracking_path = get_track_path(data_type)
-    with open(tracking_path, "r") as file:
-        tracking_data = json.load(file)
-    return tracking_data
+    return get_tracking_store(data_type).data
 
 
+def close_tracking_store(data_type):
+    # compacts the journal into data/meritindia/track/<data_type>.json
+    if data_type in tracking_stores:
+        tracking_stores.pop(data_type).close()
+
+
+@functools.cache
 def load_state_codes() -> dict[str, str]:
+    # read once per process, warm lambda invocations reuse it. Callers must not modify it
     with open(state_codes_path, "r") as file:
         state_codes = json.load(file)
     return state_codes
 
 
-def save_tracking_data(data_type: str, tracking_data: dict):
-    tracking_path = get_track_path(data_type)
-    with open(tracking_path, "w") as file:
-        json.dump(tracking_data, file, indent=4)
-
-
 def get_merit_format_date(date: str):
     _date = datetime.strptime(date, "%Y-%m-%d").date()
     return _date.strftime("%d %b %Y")
@@ -66,7 +128,7 @@ def get_rows_by_state(rows: list[dict]):
     return rows_by_state
 
 
-def save_data(data_type: str, rows: list[dict]):
+def get_headers(data_type: str) -> list[str]:
     if data_type == "daily-state-generation":
         headers = [
             "StateCode",
@@ -90,30 +152,52 @@ def save_data(data_type: str, rows: list[dict]):
             "TypeOfGeneration",
             "fetched_at",
         ]
+    else:
+        raise ValueError(f"Unknown data type: {data_type}")
+    return headers
+
+
+def save_data(data_type: str, rows: list[dict]):
+    headers = get_headers(data_type)
     dest_dir = output_dir / data_type / "raw"
     dest_dir.mkdir(parents=True, exist_ok=True)
     # group rows by state code
     rows_by_state = get_rows_by_state(rows)
+    key_index = get_key_index(data_type)
+    plant_rows = {}
     for state_code, rows in rows_by_state.items():
+        new_rows = key_index.filter(state_code, rows)
+        if len(new_rows) < len(rows):
+            metrics.incr("rows_duplicate", len(rows) - len(new_rows))
+            print(f"{len(rows) - len(new_rows)} duplicates skipped for {state_code}")
+        if not new_rows:
+            continue
         file_path = dest_dir / f"{state_code}.csv"
         is_file_present = file_path.exists()
         with open(file_path, "a") as file:
             csv_writer = csv.DictWriter(file, fieldnames=headers)
             if not is_file_present:
                 csv_writer.writeheader()
-            csv_writer.writerows(rows)
-        print(f"{len(rows)} written for {state_code}")
+            csv_writer.writerows(new_rows)
+        key_index.commit([state_code])
+        if data_type == "daily-plant-generation":
+            plant_rows[state_code] = new_rows
+        metrics.incr("rows_written", len(new_rows))
+        print(f"{len(new_rows)} written for {state_code}")
+    if plant_rows:
+        save_plant_rows(plant_rows)
 
 
 def get_daily_state_generation(state_code, date: str):
     req_date_str = get_merit_format_date(date)
-    res = requests.request(
-        "POST",
+    res = get_session(concurrency.max_limit).post(
         url,
         data={"StateCode": state_code, "date": req_date_str},
         verify=False,
         headers={"Host": merit_domain},
     )
+    metrics.incr("bytes_fetched", len(res.content))
+    res.raise_for_status()
     data = res.json()
     row = {
         "fetched_at": ist_now(),
@@ -128,13 +212,14 @@ def get_daily_state_generation(state_code, date: str):
 
 def get_daily_plant_generation(state_code, date: str):
     req_date_str = get_merit_format_date(date)
-    res = requests.request(
-        "POST",
+    res = get_session(concurrency.max_limit).post(
         plant_url,
         data={"StateCode": state_code, "date": req_date_str},
         verify=False,
         headers={"Host": merit_domain},
     )
+    metrics.incr("bytes_fetched", len(res.content))
+    res.raise_for_status()
     data = res.json()
     row = {
         "fetched_at": ist_now(),
@@ -179,69 +264,237 @@ def get_request_inputs(data_type: str) -> Iterable[tuple[str, str]]:
             yield state_code, str(date)
 
 
-def get_data(data_type, request_inputs: list[tuple[str, str]]):
+class StateCsvWriters:
+    """
+    Long lived csv writers, one per state file of a data type, for writing rows as they arrive.
+    * a state file is opened once, the header is only written to a new file
+    * files are flushed every flush_interval seconds and on close
+    * dates passed to mark_fetched go to the tracking data after the next flush, once their rows are on disk
+    * rows already in a state file are skipped, their keys are committed to the key index on flush
+    * plant rows go to the plant catalog (and compact storage) on flush, after the raw rows are on disk
+    """
+
+    def __init__(self, data_type: str, flush_interval: float = flush_interval):
+        self.data_type = data_type
+        self.headers = get_headers(data_type)
+        self.dest_dir = output_dir / data_type / "raw"
+        self.flush_interval = flush_interval
+        self.files = {}
+        self.writers = {}
+        self.fetched = {}
+        self.written = {}
+        self.duplicates = 0
+        self.plant_rows = {}
+        self.key_index = get_key_index(data_type)
+        self.last_flush = time.monotonic()
+
+    def get_writer(self, state_code) -> csv.DictWriter:
+        if state_code not in self.writers:
+            self.dest_dir.mkdir(parents=True, exist_ok=True)
+            file_path = self.dest_dir / f"{state_code}.csv"
+            is_file_present = file_path.exists() and file_path.stat().st_size > 0
+            file = open(file_path, "a")
+            writer = csv.DictWriter(file, fieldnames=self.headers)
+            if not is_file_present:
+                writer.writeheader()
+            self.files[state_code] = file
+            self.writers[state_code] = writer
+        return self.writers[state_code]
+
+    def write(self, rows: list[dict]):
+        for state_code, state_rows in get_rows_by_state(rows).items():
+            new_rows = self.key_index.filter(state_code, state_rows)
+            self.duplicates += len(state_rows) - len(new_rows)
+            metrics.incr("rows_duplicate", len(state_rows) - len(new_rows))
+            state_rows = new_rows
+            self.get_writer(state_code).writerows(state_rows)
+            if self.data_type == "daily-plant-generation" and state_rows:
+                self.plant_rows.setdefault(state_code, []).extend(state_rows)
+            self.written[state_code] = self.written.get(state_code, 0) + len(state_rows)
+            metrics.incr("rows_written", len(state_rows))
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def mark_fetched(self, state_code, date: str):
+        self.fetched[state_code] = date
+
+    def flush(self):
+        for file in self.files.values():
+            file.flush()
+        self.key_index.commit(list(self.files))
+        if self.plant_rows:
+            save_plant_rows(self.plant_rows)
+            self.plant_rows = {}
+        if self.fetched:
+            update_tracking_metadata(
+                self.data_type,
+                [
+                    {"StateCode": state_code, "DateTime": date}
+                    for state_code, date in self.fetched.items()
+                ],
+            )
+            self.fetched = {}
+        for state_code, count in self.written.items():
+            print(f"{count} written for {state_code}")
+        if self.duplicates:
+            print(f"{self.duplicates} duplicates skipped")
+        self.written = {}
+        self.duplicates = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+        self.writers = {}
+
+
+def get_data_getter(data_type):
     if data_type == "daily-state-generation":
-        data_getter = get_daily_state_generation
+        return get_daily_state_generation
     elif data_type == "daily-plant-generation":
-        data_getter = get_daily_plant_generation
+        return get_daily_plant_generation
     else:
         raise ValueError(f"Unknown data type: {data_type}")
+
+
+def get_data(data_type, request_inputs: list[tuple[str, str]], max_concurrency=None):
+    """
+    max_concurrency caps the parallel requests of this call, the proxy client sends its share of max_workers
+    when it keeps several batches in flight
+    """
+    data_getter = get_data_getter(data_type)
+    concurrency.set_max_limit(max_concurrency or max_workers)
     all_rows = []
     total_latency = 0
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = []
-        for input in request_inputs:
-            futures.append(executor.submit(data_getter, *input))
-
-        for future in concurrent.futures.as_completed(futures):
-            rows, latency = future.result()
-            total_latency += latency
-            all_rows.extend(rows)
+    concurrency.reset_stats()
+    for rows, latency in map_adaptive(data_getter, request_inputs, concurrency):
+        total_latency += latency
+        metrics.observe("http_latency_s", latency)
+        all_rows.extend(rows)
     # note that the order of the results is not guaranteed to be the same as the order of the inputs
     print("Average latency:", total_latency / len(request_inputs))
+    print("Concurrency:", concurrency.summary())
+    metrics.set_gauge("concurrency", concurrency.current)
+    metrics.incr("rows_fetched", len(all_rows))
     return all_rows
 
 
-def get_new_tracking_metadata(rows, old_trm):
-    new_trm = old_trm.copy()
+def stream_data(
+    data_type,
+    request_inputs: Iterable[tuple[str, str]],
+    writers: StateCsvWriters,
+):
+    """
+    Like get_data, but rows are written as each request completes instead of being collected.
+    Inputs are only taken as requests complete (at most concurrency.current at a time), so memory does not grow
+    with the number of inputs. Requests complete out of order, a state is marked as fetched up to a date only
+    once all the earlier dates of that state are written. Like in batch mode (get_latest_dates) only dates that
+    returned rows are marked, a date the site has not published yet is requested again in the next run.
+    """
+    data_getter = get_data_getter(data_type)
+    # dates of each state in the order they were requested, and the ones completed out of order
+    # with whether they returned rows
+    pending_dates = {}
+    completed = {}
+    total_latency = 0
+    no_of_requests = 0
+
+    def get_inputs():
+        for state_code, date in request_inputs:
+            pending_dates.setdefault(state_code, deque()).append(date)
+            yield state_code, date
+
+    def fetch(state_code, date):
+        rows, latency = data_getter(state_code, date)
+        return state_code, date, rows, latency
+
+    concurrency.set_max_limit(max_workers)
+    concurrency.reset_stats()
+    for state_code, date, rows, latency in map_adaptive(
+        fetch, get_inputs(), concurrency
+    ):
+        total_latency += latency
+        no_of_requests += 1
+        metrics.observe("http_latency_s", latency)
+        writers.write(rows)
+
+        completed[(state_code, date)] = state_code in get_latest_dates(rows)
+        dates = pending_dates[state_code]
+        while dates and (state_code, dates[0]) in completed:
+            date = dates.popleft()
+            if completed.pop((state_code, date)):
+                writers.mark_fetched(state_code, date)
+    if no_of_requests > 0:
+        print("Average latency:", total_latency / no_of_requests)
+    print("Concurrency:", concurrency.summary())
+
+
+def get_latest_dates(rows) -> dict[str, str]:
+    # latest date in the rows for each state
+    latest_dates = {}
     for row in rows:
         state_code = row["StateCode"]
-        if state_code not in new_trm:
-            new_trm[state_code] = {"last_fetched": row["DateTime"]}
-        else:
-            old_date = datetime.strptime(
-                new_trm[state_code]["last_fetched"], "%Y-%m-%d"
-            )
-            new_date = datetime.strptime(row["DateTime"], "%Y-%m-%d")
-            if new_date > old_date:
-                new_trm[state_code]["last_fetched"] = row["DateTime"]
-    return new_trm
+        if state_code not in latest_dates or datetime.strptime(
+            row["DateTime"], "%Y-%m-%d"
+        ) > datetime.strptime(latest_dates[state_code], "%Y-%m-%d"):
+            latest_dates[state_code] = row["DateTime"]
+    return latest_dates
 
 
 def update_tracking_metadata(data_type: str, rows: list[dict]):
-    tracking_metadata = load_tracking_data(data_type)
-    tracking_metadata = get_new_tracking_metadata(rows, tracking_metadata)
-    save_tracking_data(data_type, tracking_metadata)
+    # one journal entry per state that moved forward, instead of rewriting the tracking file
+    tracking_store = get_tracking_store(data_type)
+    for state_code, date in get_latest_dates(rows).items():
+        last_fetched = tracking_store.get([state_code, "last_fetched"])
+        if last_fetched is None or datetime.strptime(
+            date, "%Y-%m-%d"
+        ) > datetime.strptime(last_fetched, "%Y-%m-%d"):
+            tracking_store.set([state_code, "last_fetched"], date)
 
 
-def run():
-    data_type = "daily-state-generation"
-
+def run(data_type="daily-state-generation", stream=False):
     def process_batch(batch):
         rows = get_data(data_type, batch)
         save_data(data_type, rows)
         update_tracking_metadata(data_type, rows)
 
     request_inputs = get_request_inputs(data_type)
+    if stream:
+        writers = StateCsvWriters(data_type)
+        try:
+            stream_data(data_type, request_inputs, writers)
+        finally:
+            writers.close()
+            close_tracking_store(data_type)
+        return
+
     batch = []
-    for input in request_inputs:
-        batch.append(input)
-        if len(batch) == batch_size:
+    try:
+        for input in request_inputs:
+            batch.append(input)
+            if len(batch) == batch_size:
+                process_batch(batch)
+                batch = []
+        if batch:
             process_batch(batch)
-            batch = []
-    if batch:
-        process_batch(batch)
+    finally:
+        close_tracking_store(data_type)
 
 
 if __name__ == "__main__":
-    run()
+    parser = argparse.ArgumentParser(description="Fetch daily generation directly")
+    parser.add_argument(
+        "data_type",
+        nargs="?",
+        default="daily-state-generation",
+        choices=["daily-state-generation", "daily-plant-generation"],
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write rows as requests complete instead of in batches",
+    )
+    args = parser.parse_args()
+    run(args.data_type, args.stream)
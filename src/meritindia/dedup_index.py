@@ -0,0 +1,136 @@
+"""
+Index of the row keys in the state files of a daily data type, so rows that are already in a file are not appended again
+(re-runs, overlapping batches, tracking data that was reset). Only uses the standard library.
+
+* a key is the 8 byte blake2b hash of the key fields of a row (StateCode, DateTime and PowerStationName for plants)
+* <data type>/index/<StateCode>.keys holds the keys of a state file as uint64, <data type>/index/sizes.json the size
+  of every state file when its keys were written
+* keys are only written after the rows are in the state file. An index whose recorded size does not match the file
+  (for ex. rows written by an older version, or a run stopped in between) is rebuilt from the file when it is loaded
+* the indexes are local and not committed (see .gitignore), a fresh clone (or a CI run) builds the index of a state
+  from its file the first time the state is written
+
+    python dedup_index.py rebuild daily-plant-generation    # rebuild the indexes of all the state files
+"""
+
+import argparse
+import array
+import csv
+import hashlib
+import json
+from pathlib import Path
+
+data_dir = Path("../../data/meritindia/")
+key_fields = {
+    "daily-state-generation": ["StateCode", "DateTime"],
+    "daily-plant-generation": ["StateCode", "DateTime", "PowerStationName"],
+}
+
+
+def get_key(row: dict, fields: list[str]) -> int:
+    key = "\0".join(str(row.get(field, "")) for field in fields)
+    return int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=8).digest(), "little"
+    )
+
+
+class KeyIndex:
+    def __init__(self, data_type: str, base_dir: Path = None):
+        base_dir = Path(base_dir or data_dir) / data_type
+        self.fields = key_fields[data_type]
+        self.csv_dir = base_dir / "raw"
+        self.index_dir = base_dir / "index"
+        self.sizes_path = self.index_dir / "sizes.json"
+        self.sizes = {}
+        if self.sizes_path.exists():
+            with open(self.sizes_path, "r") as file:
+                self.sizes = json.load(file)
+        self.keys = {}
+        self.pending = {}
+
+    def get_csv_path(self, state_code) -> Path:
+        return self.csv_dir / f"{state_code}.csv"
+
+    def get_keys_path(self, state_code) -> Path:
+        return self.index_dir / f"{state_code}.keys"
+
+    def get_keys(self, state_code) -> set[int]:
+        if state_code not in self.keys:
+            csv_path = self.get_csv_path(state_code)
+            csv_size = csv_path.stat().st_size if csv_path.exists() else 0
+            keys_path = self.get_keys_path(state_code)
+            if csv_size == 0:
+                keys_path.unlink(missing_ok=True)
+                self.keys[state_code] = set()
+            elif self.sizes.get(state_code) == csv_size and keys_path.exists():
+                keys = array.array("Q")
+                with open(keys_path, "rb") as file:
+                    keys.frombytes(file.read())
+                self.keys[state_code] = set(keys)
+            else:
+                self.rebuild(state_code)
+        return self.keys[state_code]
+
+    def rebuild(self, state_code):
+        # keys of all the rows of the state file, duplicates already in the file map to the same key
+        csv_path = self.get_csv_path(state_code)
+        keys = set()
+        if csv_path.exists():
+            with open(csv_path, "r") as file:
+                for row in csv.DictReader(file):
+                    keys.add(get_key(row, self.fields))
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.get_keys_path(state_code), "wb") as file:
+            array.array("Q", sorted(keys)).tofile(file)
+        self.keys[state_code] = keys
+        self.pending.pop(state_code, None)
+        self.record_sizes([state_code])
+        print(f"Rebuilt the key index of {csv_path}, {len(keys)} keys")
+
+    def filter(self, state_code, rows: list[dict]) -> list[dict]:
+        """
+        Rows of the state whose key is not in the file yet (or earlier in rows), their keys are added to the index.
+        Call commit once the returned rows are in the file.
+        """
+        keys = self.get_keys(state_code)
+        pending = self.pending.setdefault(state_code, array.array("Q"))
+        new_rows = []
+        for row in rows:
+            key = get_key(row, self.fields)
+            if key in keys:
+                continue
+            keys.add(key)
+            pending.append(key)
+            new_rows.append(row)
+        return new_rows
+
+    def commit(self, state_codes: list[str]):
+        # writes the keys of the rows written to the state files since the last commit
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        for state_code in state_codes:
+            pending = self.pending.pop(state_code, None)
+            if pending:
+                with open(self.get_keys_path(state_code), "ab") as file:
+                    pending.tofile(file)
+        self.record_sizes(state_codes)
+
+    def record_sizes(self, state_codes: list[str]):
+        for state_code in state_codes:
+            csv_path = self.get_csv_path(state_code)
+            self.sizes[state_code] = csv_path.stat().st_size if csv_path.exists() else 0
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = self.sizes_path.with_suffix(".tmp")
+        with open(temp_path, "w") as file:
+            json.dump(self.sizes, file, indent=4, sort_keys=True)
+        temp_path.replace(self.sizes_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Key indexes of the daily state files")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("data_type", choices=list(key_fields))
+    parser.add_argument("--data-dir", type=Path, default=data_dir)
+    args = parser.parse_args()
+    index = KeyIndex(args.data_type, args.data_dir)
+    for csv_path in sorted(index.csv_dir.glob("*.csv")):
+        index.rebuild(csv_path.stem)
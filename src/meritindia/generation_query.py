@@ -0,0 +1,279 @@
+"""
+Resampled queries over the current generation history in series_store. Only uses the standard library.
+
+* query() returns one row per hour, day, week (from Monday) or month (IST) of a state's series with
+  the count, mean, min, max and the hour of the peak of every metric
+* hourly buckets are computed from the series, only the months that overlap the range are read
+* day, week and month buckets are merged from daily rollups (count, sum, min, max and time of the max per metric)
+  kept in series/rollups/<store>/<StateCode>.json. Like the series they are local and not committed (see .gitignore),
+  a rollup that does not cover all the rows of the series (missing, or the store synced new rows) is rebuilt
+* results are cached (LRU) with the modification times of the files they were computed from,
+  a write to the series or the rollups makes the next query recompute
+
+    python generation_query.py states MHA --freq week --start 2024-06-01 --end 2024-08-31
+"""
+
+import argparse
+import functools
+import json
+import math
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import series_store
+from series_store import SeriesStore, ist
+
+freqs = ["hour", "day", "week", "month"]
+day_seconds = 24 * 60 * 60
+cache_size = 256
+
+
+def get_bucket(timestamp: int, freq) -> int:
+    # start of the hour, day, week or month (IST) of the timestamp
+    date = datetime.fromtimestamp(timestamp, ist)
+    if freq == "hour":
+        date = date.replace(minute=0, second=0, microsecond=0)
+    else:
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        if freq == "week":
+            date -= timedelta(days=date.weekday())
+        elif freq == "month":
+            date = date.replace(day=1)
+    return int(date.timestamp())
+
+
+def new_stats() -> list:
+    # count, sum, min, max, timestamp of the max
+    return [0, 0.0, math.inf, -math.inf, None]
+
+
+def dump_stats(stats: list) -> list:
+    # min and max of a metric without values (inf, -inf) are saved as null, plain json
+    if stats[0] == 0:
+        return [0, 0.0, None, None, None]
+    return stats
+
+
+def load_stats(stats: list) -> list:
+    if stats[0] == 0:
+        return new_stats()
+    return stats
+
+
+def add_value(stats: list, value: float, timestamp: int):
+    if math.isnan(value):
+        return
+    stats[0] += 1
+    stats[1] += value
+    stats[2] = min(stats[2], value)
+    if value > stats[3]:
+        stats[3] = value
+        stats[4] = timestamp
+
+
+def merge_stats(stats: list, other: list):
+    if other[0] == 0:
+        return
+    stats[0] += other[0]
+    stats[1] += other[1]
+    stats[2] = min(stats[2], other[2])
+    if other[3] > stats[3]:
+        stats[3] = other[3]
+        stats[4] = other[4]
+
+
+def resample(timestamps, columns: dict, metrics: list[str], freq) -> dict[int, list]:
+    # bucket -> stats per metric, for the series of one state
+    buckets = {}
+    # consecutive snapshots fall in the same bucket, get_bucket only runs when the bucket can change
+    bucket_end = None
+    for index, timestamp in enumerate(timestamps):
+        if bucket_end is None or not bucket_start <= timestamp < bucket_end:
+            bucket_start = get_bucket(timestamp, freq)
+            bucket_end = get_bucket_end(bucket_start, freq)
+            if bucket_start not in buckets:
+                buckets[bucket_start] = [new_stats() for _ in metrics]
+            bucket = buckets[bucket_start]
+        for stats, metric in zip(bucket, metrics):
+            add_value(stats, columns[metric][index], timestamp)
+    return buckets
+
+
+def get_bucket_end(bucket_start: int, freq) -> int:
+    date = datetime.fromtimestamp(bucket_start, ist)
+    if freq == "hour":
+        return bucket_start + 60 * 60
+    if freq == "day":
+        return bucket_start + day_seconds
+    if freq == "week":
+        return bucket_start + 7 * day_seconds
+    next_month = (date.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return int(next_month.timestamp())
+
+
+class Rollups:
+    """
+    Daily stats of every state of a store, in series/rollups/<store>/<StateCode>.json:
+    {"rows": rows of the series rolled up, "days": {day timestamp: [[count, sum, min, max, peak timestamp] per metric]}}
+    min, max and peak timestamp are null for a metric without values that day
+    """
+
+    def __init__(self, store: SeriesStore):
+        self.store = store
+        # next to the store, not in it, the directories of a store are its states
+        self.base_dir = store.base_dir.parent / "rollups" / store.base_dir.name
+
+    def get_path(self, state_code) -> Path:
+        return self.base_dir / f"{state_code}.json"
+
+    def load(self, state_code) -> dict:
+        path = self.get_path(state_code)
+        if not path.exists():
+            return {"rows": 0, "days": {}}
+        with open(path, "r") as file:
+            rollup = json.load(file)
+        rollup["days"] = {
+            int(day): [load_stats(stats) for stats in day_stats]
+            for day, day_stats in rollup["days"].items()
+        }
+        return rollup
+
+    def save(self, state_code, rollup: dict):
+        self.base_dir.mkdir(parents=True, exist_ok=True)
+        path = self.get_path(state_code)
+        temp_path = path.with_suffix(".tmp")
+        days = {
+            day: [dump_stats(stats) for stats in day_stats]
+            for day, day_stats in rollup["days"].items()
+        }
+        with open(temp_path, "w") as file:
+            json.dump(
+                {"rows": rollup["rows"], "days": days},
+                file,
+                separators=(",", ":"),
+                allow_nan=False,
+            )
+        temp_path.replace(path)
+
+    def rebuild(self, state_code) -> dict:
+        timestamps, columns = self.store.read(state_code)
+        days = resample(timestamps, columns, self.store.metrics, "day")
+        rollup = {"rows": len(timestamps), "days": days}
+        self.save(state_code, rollup)
+        return rollup
+
+    def get(self, state_code) -> dict:
+        # rollup of the state, rebuilt when it does not cover the rows of the series
+        rollup = self.load(state_code)
+        if rollup["rows"] != self.store.count(state_code):
+            print(f"Rebuilding rollups of {state_code}")
+            rollup = self.rebuild(state_code)
+        return rollup
+
+
+def get_mtime(path: Path) -> float:
+    return path.stat().st_mtime if path.exists() else None
+
+
+def get_source_mtimes(store: SeriesStore, state_code, start, end, freq) -> tuple:
+    # the files a query reads (or checks), a change to any of them invalidates its cached result
+    if freq == "hour":
+        months = store.get_months(state_code, start, end)
+        rollup_mtime = None
+    else:
+        # the rollup is checked against the row count of all the months
+        months = store.get_months(state_code)
+        rollup_mtime = get_mtime(Rollups(store).get_path(state_code))
+    month_mtimes = tuple(
+        (month, get_mtime(store.get_paths(state_code, month)[0])) for month in months
+    )
+    return month_mtimes, rollup_mtime
+
+
+def query(
+    store: SeriesStore, state_code, freq="day", start: int = None, end: int = None
+) -> list[dict]:
+    """
+    Resampled series of a state, buckets that start within start..end (seconds since epoch, both optional).
+    Day, week and month buckets at the edges of the range cover whole days, weeks and months.
+    """
+    if freq not in freqs:
+        raise ValueError(f"Unknown freq: {freq}")
+    source_mtimes = get_source_mtimes(store, state_code, start, end, freq)
+    rows = cached_query(store, state_code, freq, start, end, source_mtimes)
+    # copies, the cached rows must not be modified
+    return [dict(row) for row in rows]
+
+
+@functools.lru_cache(maxsize=cache_size)
+def cached_query(store, state_code, freq, start, end, source_mtimes) -> list[dict]:
+    # source_mtimes is only part of the cache key
+    metrics = store.metrics
+    if freq == "hour":
+        timestamps, columns = store.read(state_code, start, end)
+        buckets = resample(timestamps, columns, metrics, "hour")
+    else:
+        buckets = {}
+        days = Rollups(store).get(state_code)["days"]
+        for day in sorted(days):
+            bucket_start = get_bucket(day, freq)
+            if bucket_start not in buckets:
+                buckets[bucket_start] = [new_stats() for _ in metrics]
+            for stats, day_stats in zip(buckets[bucket_start], days[day]):
+                merge_stats(stats, day_stats)
+    rows = []
+    for bucket_start in sorted(buckets):
+        if (start is not None and bucket_start < get_bucket(start, freq)) or (
+            end is not None and bucket_start > end
+        ):
+            continue
+        row = {"StateCode": state_code, "Datetime": bucket_start}
+        for metric, (count, total, min_value, max_value, peak_at) in zip(
+            metrics, buckets[bucket_start]
+        ):
+            row[f"{metric}_count"] = count
+            row[f"{metric}_mean"] = total / count if count else math.nan
+            row[f"{metric}_min"] = min_value if count else math.nan
+            row[f"{metric}_max"] = max_value if count else math.nan
+            row[f"{metric}_peak_hour"] = (
+                get_bucket(peak_at, "hour") if peak_at is not None else None
+            )
+        rows.append(row)
+    return rows
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Resampled current generation")
+    parser.add_argument("store", choices=list(series_store.store_metrics))
+    parser.add_argument("state_code")
+    parser.add_argument("--freq", choices=freqs, default="day")
+    parser.add_argument("--start", help="YYYY-MM-DD")
+    parser.add_argument("--end", help="YYYY-MM-DD, included")
+    parser.add_argument("--series-dir", type=Path, default=series_store.series_dir)
+    return parser.parse_args()
+
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "" if math.isnan(value) else f"{value:.1f}"
+    return str(value)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = series_store.get_store(args.store, args.series_dir)
+    # the store is a local copy of the csv files, it catches up with them first
+    series_store.sync(store, series_store.get_csv_files(args.store))
+    start = series_store.parse_date(args.start) if args.start else None
+    end = series_store.parse_date(args.end, end=True) if args.end else None
+    rows = query(store, args.state_code, args.freq, start, end)
+    if rows:
+        print(",".join(rows[0]))
+    for row in rows:
+        row["Datetime"] = series_store.format_timestamp(row["Datetime"])
+        for column in row:
+            if column.endswith("_peak_hour") and row[column] is not None:
+                row[column] = series_store.format_timestamp(row[column])
+        print(",".join(format_value(value) for value in row.values()))
@@ -1,7 +1,35 @@
 # simple AWS lambda function to run on AWS Cloud (Mumbai region) since meritindia.in is not accessible outside India.
+"""
+Only the helper of the event type is imported, on the first event that needs it, so an hourly
+current-generation cold start does not pay for daily_generation_helper (tracking store, csv writers etc.).
+Imported helpers and the state codes stay loaded for the warm invocations that follow.
+
+Self-check of the import cost, `-X importtime` style (run from src/meritindia):
+
+    python lambda_function.py --import-time current-state-generation
+"""
+
+import importlib
 import json
-import daily_generation_helper as dgh
-import current_generation_helper as cgh
+import sys
+
+import metrics
+import response_format
+
+# event type -> helper module, imported lazily by get_helper
+helper_modules = {
+    "current-state-generation": "current_generation_helper",
+    "current-india-generation": "current_generation_helper",
+    "daily-state-generation": "daily_generation_helper",
+    "daily-plant-generation": "daily_generation_helper",
+}
+
+
+def get_helper(event_type):
+    if event_type not in helper_modules:
+        raise ValueError(f"Unknown type: {event_type}")
+    # importlib caches the module in sys.modules, only the first event of a container imports it
+    return importlib.import_module(helper_modules[event_type])
 
 
 def lambda_handler(event, context):
@@ -9,17 +37,89 @@ def lambda_handler(event, context):
     req_body = json.loads(event["body"])
 
     assert "type" in req_body, "Request body does not contain type"
+    # optional, see response_format for the formats
+    format = req_body.get("format", "rows")
+    # metrics of the invocation go to the logs and back to the caller
+    metrics.start_run(f"lambda-{req_body['type']}")
+    cold_import = helper_modules.get(req_body["type"]) not in sys.modules
+    with metrics.timer("helper_import_s"):
+        helper = get_helper(req_body["type"])
+    metrics.set_gauge("cold_import", cold_import)
     match req_body["type"]:
         case "current-state-generation":
-            rows = cgh.get_data()
+            rows = helper.get_data()
         case "current-india-generation":
-            rows = cgh.get_india_row()
-        case "daily-state-generation":
-            assert "inputs" in req_body, "Request body does not contain inputs"
-            rows = dgh.get_data("daily-state-generation", req_body["inputs"])
-        case "daily-plant-generation":
+            rows = helper.get_india_row()
+        case "daily-state-generation" | "daily-plant-generation":
             assert "inputs" in req_body, "Request body does not contain inputs"
-            rows = dgh.get_data("daily-plant-generation", req_body["inputs"])
-        case _:
-            raise ValueError(f"Unknown type: {req_body['type']}")
-    return {"statusCode": 200, "body": {"data": rows}}
+            # optional, the share of the meritindia concurrency of this batch
+            rows = helper.get_data(
+                req_body["type"], req_body["inputs"], req_body.get("max_concurrency")
+            )
+    with metrics.timer("encode_s"):
+        data = response_format.encode_rows(rows, format)
+    record = metrics.finish_run()
+    return {"statusCode": 200, "body": {"data": data, "metrics": record}}
+
+
+def parse_import_times(stderr: str) -> list[tuple[str, int, int]]:
+    # lines of `python -X importtime`: "import time: self [us] | cumulative | imported package"
+    times = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times.append((name.strip(), int(self_us), int(cumulative_us)))
+    return times
+
+
+def report_import_times(event_type, top=15):
+    """
+    Imports this module and the helper of event_type in a fresh interpreter with -X importtime and prints
+    * the time of the module import (paid by every cold start) and of the helper import (paid by the first event)
+    * the top modules by their own import time
+    """
+    import subprocess
+
+    # -X importtime times the import statement (the C import path). importlib.import_module loads the module
+    # through importlib._bootstrap, the helper gets no line of its own, only the modules it imports are listed.
+    # The helper import is timed here instead
+    code = (
+        "import time; start = time.perf_counter(); import lambda_function; "
+        "middle = time.perf_counter(); lambda_function.get_helper(%r); end = time.perf_counter(); "
+        "print(middle - start, end - middle)" % event_type
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    module_s, helper_s = map(float, result.stdout.split())
+    times = parse_import_times(result.stderr)
+    print(f"Imports for {event_type}:")
+    print(f"  {'lambda_function':<32} {module_s * 1000:>8.1f} ms")
+    print(f"  {helper_modules[event_type]:<32} {helper_s * 1000:>8.1f} ms")
+    print(f"Top {top} modules by self time:")
+    for name, self_us, cumulative_us in sorted(times, key=lambda t: -t[1])[:top]:
+        print(
+            f"  {name:<32} self {self_us / 1000:>8.1f} ms  cumulative {cumulative_us / 1000:>8.1f} ms"
+        )
+    total_us = sum(self_us for _, self_us, _ in times)
+    print(f"Total import time: {total_us / 1000:.1f} ms over {len(times)} modules")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Lambda function self checks")
+    parser.add_argument(
+        "--import-time",
+        metavar="TYPE",
+        choices=list(helper_modules),
+        required=True,
+        help="report the import time of the handler for an event type",
+    )
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+    report_import_times(args.import_time, args.top)
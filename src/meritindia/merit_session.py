@@ -0,0 +1,82 @@
+"""
+Shared requests session for the meritindia requests of daily_generation_helper and current_generation_helper.
+* keep-alive connections to the pinned IP, the pool holds one connection per worker thread
+* a default timeout for every request
+* only GET requests are retried here, on connect and read errors, with exponential backoff (0.5s, 1s).
+  POST requests are not retried by the session, timeouts and 5xx of those are retried by map_adaptive
+  (adaptive_concurrency), one retry layer per request
+The session is created once per process, in the lambda it is reused by warm invocations. A session replaced by
+one with a bigger pool is closed.
+"""
+
+import threading
+
+import requests
+from urllib3.util.retry import Retry
+
+# two attempts of a request and the delay before the retry (adaptive_concurrency) fit in the 120s proxy timeout
+default_timeout = 55
+
+
+class GetRetry(Retry):
+    # urllib3 retries connect errors of every method, allowed_methods only limits read and status retries
+    def increment(
+        self,
+        method=None,
+        url=None,
+        response=None,
+        error=None,
+        _pool=None,
+        _stacktrace=None,
+    ):
+        if error is not None and not self._is_method_retryable(method):
+            # no retries left, raises the error
+            return Retry(total=0).increment(
+                method, url, response, error, _pool, _stacktrace
+            )
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+retries = GetRetry(
+    total=2,
+    connect=2,
+    read=2,
+    status=0,
+    other=0,
+    backoff_factor=0.5,
+    allowed_methods=frozenset(["GET"]),
+    raise_on_status=False,
+)
+lock = threading.Lock()
+sessions = {}
+
+
+class TimeoutSession(requests.Session):
+    def __init__(self, timeout: float):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def get_session(pool_size: int, timeout: float = default_timeout) -> requests.Session:
+    """
+    Session with at least pool_size connections per host, shared by all the threads of the process
+    """
+    with lock:
+        session = sessions.get(timeout)
+        if session is None or session.pool_size < pool_size:
+            if session is not None:
+                # requests still using it finish, their connections are closed when released
+                session.close()
+            session = TimeoutSession(timeout)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=2, pool_maxsize=pool_size, max_retries=retries
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.pool_size = pool_size
+            sessions[timeout] = session
+        return session
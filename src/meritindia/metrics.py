@@ -0,0 +1,179 @@
+"""
+Run metrics (timers, counters and histograms) for download_reports.py, parse_reports.py, current_generation.py,
+daily_generation.py and the lambda function. Only uses the standard library, it is part of the lambda bundle.
+
+* start_run resets the metrics, finish_run appends one JSON line per run to <metrics_dir>/<run name>.jsonl.
+  Without a metrics_dir (lambda) the line is printed instead, it ends up in the logs.
+  METRICS_DIR overrides the metrics_dir of the scripts, the workflows point it to the runner's temp dir and upload it
+  as an artifact. data/metrics is gitignored, run metrics are not committed with the data.
+* timer/observe record values in histograms (count, sum, min, max, p50, p90, p99), incr adds to counters,
+  set_gauge keeps the last value (for ex. the concurrency level a run ended with).
+  Histograms keep at most max_samples values for the percentiles, sampled uniformly after that.
+* profile=True (or METRICS_PROFILE=1) runs cProfile for the run (calling thread only) and dumps the stats
+  next to the metrics file, open them with `python -m pstats <file>`.
+"""
+
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+max_samples = 10000
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+run_info = {}
+
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.samples = []
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if len(self.samples) < max_samples:
+            self.samples.append(value)
+        else:
+            # reservoir sampling, every value has the same chance to be kept
+            index = random.randrange(self.count)
+            if index < max_samples:
+                self.samples[index] = value
+
+    def summary(self) -> dict:
+        samples = sorted(self.samples)
+
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "min": round(self.min, 6),
+            "max": round(self.max, 6),
+            "mean": round(self.total / self.count, 6),
+            "p50": round(percentile(50), 6),
+            "p90": round(percentile(90), 6),
+            "p99": round(percentile(99), 6),
+        }
+
+
+def incr(name, value=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    with lock:
+        gauges[name] = value
+
+
+def observe(name, value):
+    with lock:
+        if name not in histograms:
+            histograms[name] = Histogram()
+        histograms[name].observe(value)
+
+
+@contextmanager
+def timer(name):
+    # seconds spent in the block, recorded in the <name> histogram
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def record_remote_run(record: dict, prefix="lambda"):
+    # metrics the lambda returned with its response: its duration and the gauges it ended with
+    if not record or record.get("duration_s") is None:
+        return
+    observe(f"{prefix}_duration_s", record["duration_s"])
+    for name, value in record.get("gauges", {}).items():
+        set_gauge(f"{prefix}.{name}", value)
+
+
+def start_run(name, metrics_dir: Path = None, profile=None):
+    if profile is None:
+        profile = os.getenv("METRICS_PROFILE") == "1"
+    if os.getenv("METRICS_DIR"):
+        metrics_dir = Path(os.getenv("METRICS_DIR"))
+    with lock:
+        counters.clear()
+        gauges.clear()
+        histograms.clear()
+        run_info.clear()
+        run_info.update(
+            {
+                "name": name,
+                "metrics_dir": metrics_dir,
+                "started_at": datetime.now(),
+                "start": time.perf_counter(),
+                "profiler": cProfile.Profile() if profile else None,
+            }
+        )
+    if run_info["profiler"] is not None:
+        run_info["profiler"].enable()
+
+
+def get_record() -> dict:
+    with lock:
+        started_at = run_info.get("started_at")
+        start = run_info.get("start")
+        return {
+            "name": run_info.get("name"),
+            "started_at": (
+                started_at.isoformat(timespec="seconds") if started_at else None
+            ),
+            "duration_s": round(time.perf_counter() - start, 3) if start else None,
+            "counters": dict(sorted(counters.items())),
+            "gauges": dict(sorted(gauges.items())),
+            "histograms": {
+                name: histogram.summary()
+                for name, histogram in sorted(histograms.items())
+            },
+        }
+
+
+def finish_run(**extra) -> dict:
+    """
+    Write the metrics of the run, extra values (for ex. the arguments of the run) are added to the record.
+    Returns the record.
+    """
+    if not run_info:
+        return get_record()
+    record = {**get_record(), **extra}
+    metrics_dir = run_info["metrics_dir"]
+    profiler = run_info["profiler"]
+    if profiler is not None:
+        profiler.disable()
+        profile_dir = metrics_dir or Path("/tmp")
+        profile_dir.mkdir(parents=True, exist_ok=True)
+        started_at = run_info["started_at"].strftime("%Y%m%d-%H%M%S")
+        profile_path = profile_dir / f"{record['name']}-{started_at}.prof"
+        profiler.dump_stats(profile_path)
+        record["profile"] = str(profile_path)
+
+    line = json.dumps(record, default=str)
+    if metrics_dir is None:
+        print(f"metrics: {line}")
+    else:
+        metrics_dir.mkdir(parents=True, exist_ok=True)
+        with open(metrics_dir / f"{record['name']}.jsonl", "a") as file:
+            file.write(line + "\n")
+        print(f"Metrics written to {metrics_dir / (record['name'] + '.jsonl')}")
+    run_info.clear()
+    return record
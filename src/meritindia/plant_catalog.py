@@ -0,0 +1,297 @@
+"""
+Catalog of the plants in daily-plant-generation and the compact storage of the plant rows. Only uses the standard library.
+
+* catalog.csv gives every (StateCode, PowerStationName) a stable integer PlantId, in the order the plants were first
+  seen. It has the last TypeOfGeneration of the plant and the first and last DateTime it was seen.
+  save_data and StateCsvWriters add the plants of the rows they write, after the rows are on disk
+* catalog_types.csv has the TypeOfGeneration of every plant since the DateTime it was first seen with it,
+  so rows from before a type change are exported with the type they had
+* compact storage (opt-in, daily_generation.py --compact-storage) appends the rows to compact/<StateCode>.csv as
+  DateTime, PlantId, NonSchedule, Schedule, fetched_at with the values as plain numbers ("1,234" -> 1234).
+  The chart values are not stored, meritindia always returns them equal to Schedule and NonSchedule,
+  rows where they differ are counted in the plant_chart_mismatch metric
+* decode_rows joins compact rows back to the raw layout (names and types from the catalog)
+
+    python plant_catalog.py convert          # catalog and compact files from the raw files
+    python plant_catalog.py export GJT       # compact rows of a state in the raw layout
+"""
+
+import argparse
+import csv
+import sys
+from pathlib import Path
+
+import metrics
+
+data_dir = Path("../../data/meritindia/daily-plant-generation")
+catalog_fields = [
+    "PlantId",
+    "StateCode",
+    "PowerStationName",
+    "TypeOfGeneration",
+    "first_seen",
+    "last_seen",
+]
+type_fields = ["PlantId", "since", "TypeOfGeneration"]
+compact_fields = ["DateTime", "PlantId", "NonSchedule", "Schedule", "fetched_at"]
+raw_fields = [
+    "StateCode",
+    "DateTime",
+    "PowerStationName",
+    "NonSchedule",
+    "Schedule",
+    "ChartShowingScheduleValue",
+    "ChartShowingNonScheduleValue",
+    "TypeOfGeneration",
+    "fetched_at",
+]
+
+
+class PlantCatalog:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.types_path = self.path.with_name("catalog_types.csv")
+        # plants by id (the position in the list) and ids by (StateCode, PowerStationName)
+        self.plants = []
+        self.ids = {}
+        # [(since, TypeOfGeneration)] of every plant id, sorted by since
+        self.types = {}
+        self.changed = False
+        if self.path.exists():
+            with open(self.path, "r", newline="") as file:
+                for plant in csv.DictReader(file):
+                    plant["PlantId"] = int(plant["PlantId"])
+                    assert plant["PlantId"] == len(self.plants), f"Gap in {self.path}"
+                    self.plants.append(plant)
+                    self.ids[(plant["StateCode"], plant["PowerStationName"])] = plant[
+                        "PlantId"
+                    ]
+        if self.types_path.exists():
+            with open(self.types_path, "r", newline="") as file:
+                for entry in csv.DictReader(file):
+                    self.types.setdefault(int(entry["PlantId"]), []).append(
+                        (entry["since"], entry["TypeOfGeneration"])
+                    )
+        self.add_missing_types()
+
+    def add_missing_types(self):
+        # catalogs saved before the type history only have the last type of a plant
+        for plant in self.plants:
+            if plant["PlantId"] not in self.types:
+                self.types[plant["PlantId"]] = [
+                    (plant["first_seen"], plant["TypeOfGeneration"])
+                ]
+                self.changed = True
+
+    def get_type(self, plant_id: int, date: str) -> str:
+        # type of the plant on date, the first known type for dates before it
+        history = self.types[plant_id]
+        plant_type = history[0][1]
+        for since, since_type in history:
+            if since > date:
+                break
+            plant_type = since_type
+        return plant_type
+
+    def add_type(self, plant_id: int, date: str, plant_type: str):
+        """
+        Records the type of a row of the plant in the history.
+        * a type of a row after (or before) all the rows seen so far starts (or ends) a type
+        * a row in between with another type can not be placed without the other rows, it is counted in the
+          plant_type_out_of_order metric and the history is kept
+        """
+        history = self.types.setdefault(plant_id, [])
+        if not history:
+            history.append((date, plant_type))
+        elif date >= history[-1][0]:
+            if plant_type == history[-1][1]:
+                return
+            metrics.incr("plant_type_changes")
+            history.append((date, plant_type))
+        elif date < history[0][0]:
+            if plant_type == history[0][1]:
+                return
+            metrics.incr("plant_type_changes")
+            history.insert(0, (date, plant_type))
+        else:
+            if plant_type != self.get_type(plant_id, date):
+                metrics.incr("plant_type_out_of_order")
+            return
+        self.changed = True
+
+    def get_id(self, row: dict) -> int:
+        # id of the plant of the row, the plant is added (or its type and dates updated)
+        key = (row["StateCode"], row["PowerStationName"])
+        date = row["DateTime"]
+        if key not in self.ids:
+            self.ids[key] = len(self.plants)
+            self.plants.append(
+                {
+                    "PlantId": self.ids[key],
+                    "StateCode": row["StateCode"],
+                    "PowerStationName": row["PowerStationName"],
+                    "TypeOfGeneration": row["TypeOfGeneration"],
+                    "first_seen": date,
+                    "last_seen": date,
+                }
+            )
+            self.add_type(self.ids[key], date, row["TypeOfGeneration"])
+            self.changed = True
+            return self.ids[key]
+        plant = self.plants[self.ids[key]]
+        self.add_type(plant["PlantId"], date, row["TypeOfGeneration"])
+        if date > plant["last_seen"]:
+            plant["last_seen"] = date
+            plant["TypeOfGeneration"] = row["TypeOfGeneration"]
+            self.changed = True
+        elif date < plant["first_seen"]:
+            plant["first_seen"] = date
+            self.changed = True
+        return plant["PlantId"]
+
+    def add(self, rows: list[dict]) -> list[int]:
+        return [self.get_id(row) for row in rows]
+
+    def save(self):
+        if not self.changed:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w", newline="") as file:
+            csv_writer = csv.DictWriter(file, fieldnames=catalog_fields)
+            csv_writer.writeheader()
+            csv_writer.writerows(self.plants)
+        temp_path.replace(self.path)
+        temp_path = self.types_path.with_suffix(".tmp")
+        with open(temp_path, "w", newline="") as file:
+            csv_writer = csv.writer(file)
+            csv_writer.writerow(type_fields)
+            for plant_id, history in sorted(self.types.items()):
+                csv_writer.writerows(
+                    [plant_id, since, plant_type] for since, plant_type in history
+                )
+        temp_path.replace(self.types_path)
+        self.changed = False
+
+
+def format_number(value) -> str:
+    # "1,234" -> "1234", empty values stay empty, values that are not numbers are kept as they are
+    if value is None or value == "":
+        return ""
+    try:
+        number = float(str(value).replace(",", ""))
+    except ValueError:
+        return value
+    return str(int(number)) if number.is_integer() else str(number)
+
+
+def encode_rows(catalog: PlantCatalog, rows: list[dict]) -> list[dict]:
+    compact_rows = []
+    for row, plant_id in zip(rows, catalog.add(rows)):
+        if row.get("ChartShowingScheduleValue") != row.get("Schedule") or row.get(
+            "ChartShowingNonScheduleValue"
+        ) != row.get("NonSchedule"):
+            metrics.incr("plant_chart_mismatch")
+        compact_rows.append(
+            {
+                "DateTime": row["DateTime"],
+                "PlantId": plant_id,
+                "NonSchedule": format_number(row.get("NonSchedule")),
+                "Schedule": format_number(row.get("Schedule")),
+                "fetched_at": row.get("fetched_at", ""),
+            }
+        )
+    return compact_rows
+
+
+def decode_rows(catalog: PlantCatalog, compact_rows: list[dict]) -> list[dict]:
+    rows = []
+    for compact_row in compact_rows:
+        plant_id = int(compact_row["PlantId"])
+        plant = catalog.plants[plant_id]
+        rows.append(
+            {
+                "StateCode": plant["StateCode"],
+                "DateTime": compact_row["DateTime"],
+                "PowerStationName": plant["PowerStationName"],
+                "NonSchedule": compact_row["NonSchedule"],
+                "Schedule": compact_row["Schedule"],
+                "ChartShowingScheduleValue": compact_row["Schedule"],
+                "ChartShowingNonScheduleValue": compact_row["NonSchedule"],
+                "TypeOfGeneration": catalog.get_type(plant_id, compact_row["DateTime"]),
+                "fetched_at": compact_row["fetched_at"],
+            }
+        )
+    return rows
+
+
+def get_compact_path(state_code, base_dir: Path = None) -> Path:
+    return Path(base_dir or data_dir) / "compact" / f"{state_code}.csv"
+
+
+def append_compact(catalog: PlantCatalog, state_code, rows: list[dict], base_dir=None):
+    compact_rows = encode_rows(catalog, rows)
+    # new plants are in the catalog before rows refer to them
+    catalog.save()
+    write_compact(state_code, compact_rows, base_dir)
+
+
+def write_compact(state_code, compact_rows: list[dict], base_dir=None):
+    # rows from encode_rows, their plants must be in the saved catalog
+    file_path = get_compact_path(state_code, base_dir)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    is_file_present = file_path.exists() and file_path.stat().st_size > 0
+    with open(file_path, "a", newline="") as file:
+        csv_writer = csv.DictWriter(file, fieldnames=compact_fields)
+        if not is_file_present:
+            csv_writer.writeheader()
+        csv_writer.writerows(compact_rows)
+
+
+def read_compact(catalog: PlantCatalog, state_code, base_dir=None) -> list[dict]:
+    # rows of a state in the raw layout
+    with open(get_compact_path(state_code, base_dir), "r", newline="") as file:
+        return decode_rows(catalog, csv.DictReader(file))
+
+
+def convert(base_dir: Path = None):
+    """
+    Writes the compact files of all the raw files again and adds their plants to the catalog.
+    Ids of plants already in the catalog are kept, their type history is built again from the rows,
+    which are converted (and written to the compact files) in DateTime order.
+    """
+    base_dir = Path(base_dir or data_dir)
+    catalog = PlantCatalog(base_dir / "catalog.csv")
+    catalog.types = {}
+    for raw_path in sorted((base_dir / "raw").glob("*.csv")):
+        compact_path = get_compact_path(raw_path.stem, base_dir)
+        compact_path.unlink(missing_ok=True)
+        with open(raw_path, "r", newline="") as file:
+            rows = list(csv.DictReader(file))
+        # the raw rows are in the order the dates were fetched, the type history needs them by date
+        rows.sort(key=lambda row: row["DateTime"])
+        append_compact(catalog, raw_path.stem, rows, base_dir)
+        print(f"{len(rows)} rows of {raw_path.stem} converted")
+    # plants of the catalog that are not in the raw files anymore
+    catalog.add_missing_types()
+    catalog.save()
+    print(f"{len(catalog.plants)} plants in {catalog.path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plant catalog and compact storage")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("convert", help="catalog and compact files from raw files")
+    export_parser = subparsers.add_parser(
+        "export", help="print the compact rows of a state in the raw layout"
+    )
+    export_parser.add_argument("state_code")
+    parser.add_argument("--data-dir", type=Path, default=data_dir)
+    args = parser.parse_args()
+    if args.command == "convert":
+        convert(args.data_dir)
+    else:
+        catalog = PlantCatalog(args.data_dir / "catalog.csv")
+        csv_writer = csv.DictWriter(sys.stdout, fieldnames=raw_fields)
+        csv_writer.writeheader()
+        csv_writer.writerows(read_compact(catalog, args.state_code, args.data_dir))
@@ -0,0 +1,93 @@
+"""
+Compact columnar format for the rows the lambda function returns, opt-in with "format" in the request body.
+Only uses the standard library, it is part of the lambda bundle.
+
+* rows (default): the list of dicts as it is. Every plant row repeats StateCode, DateTime, fetched_at and the key names
+* columnar: one array per field. Fields that repeat in consecutive rows (StateCode, DateTime, fetched_at,
+  often TypeOfGeneration) are stored as runs of [value, count], a field with one value for all the rows is a single run.
+  A field missing from a row comes back as None, csv.DictWriter writes both as an empty value
+* columnar-gzip: the columnar JSON, gzipped and base64 encoded
+
+decode_rows accepts all of them, so callers can switch the format without changing how they save the rows.
+A lambda response is limited to 6 MB, the compact formats let bigger batches fit in one response.
+"""
+
+import base64
+import gzip
+import json
+
+formats = ["rows", "columnar", "columnar-gzip"]
+
+
+def get_runs(values: list) -> list[list]:
+    runs = []
+    for value in values:
+        if runs and runs[-1][0] == value:
+            runs[-1][1] += 1
+        else:
+            runs.append([value, 1])
+    return runs
+
+
+def encode_columnar(rows: list[dict]) -> dict:
+    fields = {}
+    for row in rows:
+        # dict keeps the order of the fields as they first appear
+        fields.update(dict.fromkeys(row))
+    columns = {}
+    runs = {}
+    for field in fields:
+        values = [row.get(field) for row in rows]
+        field_runs = get_runs(values)
+        # a run costs about as much as two values
+        if len(field_runs) * 2 < len(values):
+            runs[field] = field_runs
+        else:
+            columns[field] = values
+    return {
+        "format": "columnar",
+        "length": len(rows),
+        "fields": list(fields),
+        "columns": columns,
+        "runs": runs,
+    }
+
+
+def decode_columnar(data: dict) -> list[dict]:
+    columns = dict(data["columns"])
+    for field, runs in data["runs"].items():
+        columns[field] = [value for value, count in runs for _ in range(count)]
+    values = [columns[field] for field in data["fields"]]
+    return [dict(zip(data["fields"], row_values)) for row_values in zip(*values)]
+
+
+def encode_rows(rows, format="rows"):
+    """
+    Encode the rows of a lambda response in format, data that is not a list of rows (the india row) is kept as it is
+    """
+    if format not in formats:
+        raise ValueError(f"Unknown response format: {format}")
+    if format == "rows" or not isinstance(rows, list):
+        return rows
+    data = encode_columnar(rows)
+    if format == "columnar-gzip":
+        compressed = gzip.compress(json.dumps(data, separators=(",", ":")).encode())
+        data = {
+            "format": "columnar-gzip",
+            "payload": base64.b64encode(compressed).decode("ascii"),
+        }
+    return data
+
+
+def decode_rows(data):
+    # data of a lambda response in any of the formats, returns the rows
+    if not isinstance(data, dict) or "format" not in data:
+        return data
+    match data["format"]:
+        case "columnar":
+            return decode_columnar(data)
+        case "columnar-gzip":
+            payload = gzip.decompress(base64.b64decode(data["payload"]))
+            return decode_columnar(json.loads(payload))
+        case _:
+            raise ValueError(f"Unknown response format: {data['format']}")
@@ -0,0 +1,365 @@
+"""
+Typed store for the current generation snapshots, next to the monthly csv files in current-generation/raw.
+Only uses the standard library.
+
+* values are parsed to numbers when the rows are saved: "4,881" -> 4881, "(15)" -> -15, "" -> nan
+* one series per state and month: <store>/<StateCode>/<YYYY-MM>.ts holds the timestamps (int64, seconds since epoch)
+  and <YYYY-MM>.values the metrics (float32, one record of len(metrics) values per timestamp), little endian.
+  Both are plain arrays, they can be memory mapped (for ex. numpy.memmap) or read with array.fromfile
+* read() only opens the files of one state for the months that overlap the requested range
+* append() first cuts both files of a month to their complete records, so an interrupted append does not shift
+  the records written after it
+* the csv files stay the published format, the store is a local copy built from them and not committed
+  (see .gitignore). sync() appends the rows added to the csv files since the last sync, <store>/sources.json has
+  the byte offset read from each csv file and a hash of the bytes before it, like compaction. A csv file that
+  changed before its offset rebuilds the store
+* export_csv writes a store back to csv
+
+    python series_store.py import states                 # (re)build the store from the raw csv files
+    python series_store.py read states MHA --start 2024-06-01 --end 2024-06-30
+    python series_store.py export india India-all.csv
+"""
+
+import argparse
+import array
+import csv
+import json
+import math
+import shutil
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from compaction import get_file_stat, get_prefix_hash, is_prefix_unchanged, read_tail
+
+raw_dir = Path("../../data/meritindia/current-generation/raw")
+series_dir = Path("../../data/meritindia/current-generation/series")
+# Datetime of the rows is IST, which has no daylight saving
+ist = timezone(timedelta(hours=5, minutes=30))
+datetime_format = "%Y-%m-%d %H:%M:%S"
+store_metrics = {
+    "states": ["Demand", "ISGS", "ImportData"],
+    "india": ["Demand", "Thermal", "GAS", "Nuclear", "Hydro", "Renewable"],
+}
+stores = {}
+
+if sys.byteorder != "little":
+    raise RuntimeError("series_store expects a little endian machine")
+
+
+def parse_number(value) -> float:
+    if value is None:
+        return math.nan
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = value.strip().replace(",", "")
+    if value == "":
+        return math.nan
+    # negative values come in accounting notation, (15)
+    if value.startswith("(") and value.endswith(")"):
+        value = "-" + value[1:-1]
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+def parse_timestamp(value: str) -> int:
+    # fromisoformat is several times faster than strptime on the import of all the csv files
+    return int(datetime.fromisoformat(value).replace(tzinfo=ist).timestamp())
+
+
+def format_timestamp(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp, ist).strftime(datetime_format)
+
+
+def get_month(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp, ist).strftime("%Y-%m")
+
+
+class SeriesStore:
+    def __init__(self, base_dir: Path, metrics: list[str]):
+        self.base_dir = Path(base_dir)
+        self.metrics = metrics
+        schema_path = self.base_dir / "schema.json"
+        if schema_path.exists():
+            with open(schema_path, "r") as file:
+                schema = json.load(file)
+            if schema["metrics"] != metrics:
+                raise ValueError(
+                    f"{self.base_dir} has metrics {schema['metrics']}, not {metrics}"
+                )
+        else:
+            self.base_dir.mkdir(parents=True, exist_ok=True)
+            with open(schema_path, "w") as file:
+                json.dump({"metrics": metrics, "timezone": "+05:30"}, file)
+
+    def get_paths(self, state_code, month) -> tuple[Path, Path]:
+        state_dir = self.base_dir / state_code
+        return state_dir / f"{month}.ts", state_dir / f"{month}.values"
+
+    def append(self, rows: list[dict]) -> int:
+        """
+        Appends the rows (with StateCode, Datetime and the metrics as in the csv files) to the series
+        of their state and month. Returns the number of rows appended.
+        """
+        groups = {}
+        for row in rows:
+            timestamp = parse_timestamp(row["Datetime"])
+            key = (row["StateCode"], get_month(timestamp))
+            timestamps, values = groups.setdefault(
+                key, (array.array("q"), array.array("f"))
+            )
+            timestamps.append(timestamp)
+            values.extend(parse_number(row.get(metric)) for metric in self.metrics)
+        for (state_code, month), (timestamps, values) in groups.items():
+            ts_path, values_path = self.get_paths(state_code, month)
+            ts_path.parent.mkdir(parents=True, exist_ok=True)
+            self.truncate_month(state_code, month)
+            # values first, a reader uses the shorter of the two if a write was interrupted
+            with open(values_path, "ab") as file:
+                values.tofile(file)
+            with open(ts_path, "ab") as file:
+                timestamps.tofile(file)
+        return len(rows)
+
+    def truncate_month(self, state_code, month):
+        # cuts both files to their complete records, after an interrupted append the next one would
+        # otherwise pair every new timestamp with the values of another record
+        paths = self.get_paths(state_code, month)
+        if not any(path.exists() for path in paths):
+            return
+        count = self.count_month(state_code, month)
+        for path, record_size in zip(paths, [8, 4 * len(self.metrics)]):
+            if path.exists() and path.stat().st_size != count * record_size:
+                print(f"Truncating {path} to {count} records")
+                with open(path, "r+b") as file:
+                    file.truncate(count * record_size)
+
+    def get_months(self, state_code, start: int = None, end: int = None) -> list[str]:
+        state_dir = self.base_dir / state_code
+        if not state_dir.exists():
+            return []
+        months = sorted(path.stem for path in state_dir.glob("*.ts"))
+        start_month = get_month(start) if start is not None else None
+        end_month = get_month(end) if end is not None else None
+        return [
+            month
+            for month in months
+            if (start_month is None or month >= start_month)
+            and (end_month is None or month <= end_month)
+        ]
+
+    def count_month(self, state_code, month) -> int:
+        # number of complete records, from the size of the files
+        ts_path, values_path = self.get_paths(state_code, month)
+        ts_size = ts_path.stat().st_size // 8 if ts_path.exists() else 0
+        values_size = (
+            values_path.stat().st_size // (4 * len(self.metrics))
+            if values_path.exists()
+            else 0
+        )
+        return min(ts_size, values_size)
+
+    def count(self, state_code) -> int:
+        return sum(
+            self.count_month(state_code, month) for month in self.get_months(state_code)
+        )
+
+    def read_month(self, state_code, month) -> tuple[array.array, array.array]:
+        ts_path, values_path = self.get_paths(state_code, month)
+        width = len(self.metrics)
+        timestamps = array.array("q")
+        values = array.array("f")
+        count = self.count_month(state_code, month)
+        with open(ts_path, "rb") as file:
+            timestamps.fromfile(file, count)
+        with open(values_path, "rb") as file:
+            values.fromfile(file, count * width)
+        return timestamps, values
+
+    def read(
+        self, state_code, start: int = None, end: int = None
+    ) -> tuple[array.array, dict[str, array.array]]:
+        """
+        Series of one state with start <= timestamp <= end (seconds since epoch, both optional).
+        Returns the timestamps and a float32 array per metric, nan where the value was missing.
+        """
+        width = len(self.metrics)
+        timestamps = array.array("q")
+        columns = {metric: array.array("f") for metric in self.metrics}
+        for month in self.get_months(state_code, start, end):
+            month_timestamps, month_values = self.read_month(state_code, month)
+            for index, timestamp in enumerate(month_timestamps):
+                if (start is not None and timestamp < start) or (
+                    end is not None and timestamp > end
+                ):
+                    continue
+                timestamps.append(timestamp)
+                record = month_values[index * width : (index + 1) * width]
+                for metric, value in zip(self.metrics, record):
+                    columns[metric].append(value)
+        return timestamps, columns
+
+    def get_state_codes(self) -> list[str]:
+        return sorted(path.name for path in self.base_dir.iterdir() if path.is_dir())
+
+
+def get_store(name, base_dir: Path = None) -> SeriesStore:
+    # one store per name and directory for the process
+    base_dir = Path(base_dir or series_dir) / name
+    if (name, base_dir) not in stores:
+        stores[(name, base_dir)] = SeriesStore(base_dir, store_metrics[name])
+    return stores[(name, base_dir)]
+
+
+def format_value(value: float) -> str:
+    if math.isnan(value):
+        return ""
+    return str(int(value)) if value.is_integer() else str(value)
+
+
+def export_csv(store: SeriesStore, output_file: Path, start=None, end=None):
+    # rows of all the states in the order of the timestamps, numbers without thousands separators
+    rows = []
+    for state_code in store.get_state_codes():
+        timestamps, columns = store.read(state_code, start, end)
+        for index, timestamp in enumerate(timestamps):
+            values = [format_value(columns[metric][index]) for metric in store.metrics]
+            rows.append((timestamp, state_code, values))
+    rows.sort(key=lambda row: (row[0], row[1]))
+    with open(output_file, "w") as file:
+        csv_writer = csv.writer(file)
+        csv_writer.writerow(["StateCode", "Datetime", *store.metrics])
+        for timestamp, state_code, values in rows:
+            csv_writer.writerow([state_code, format_timestamp(timestamp), *values])
+    print(f"{len(rows)} rows written to {output_file}")
+
+
+def get_csv_files(name, csv_dir: Path = None) -> list[Path]:
+    # csv files the rows of a store come from
+    csv_dir = Path(csv_dir or raw_dir)
+    if name == "india":
+        return [csv_dir / "India-all.csv"]
+    return sorted(csv_dir.glob("[0-9][0-9][0-9][0-9]-[0-9][0-9].csv"))
+
+
+def load_sources(store: SeriesStore) -> dict:
+    sources_path = store.base_dir / "sources.json"
+    if not sources_path.exists():
+        return {}
+    with open(sources_path, "r") as file:
+        return json.load(file)
+
+
+def save_sources(store: SeriesStore, sources: dict):
+    sources_path = store.base_dir / "sources.json"
+    temp_path = sources_path.with_suffix(".tmp")
+    with open(temp_path, "w") as file:
+        json.dump(sources, file, indent=4, sort_keys=True)
+    temp_path.replace(sources_path)
+
+
+def is_source_unchanged(csv_file: Path, source: dict) -> bool:
+    # the csv file still starts with the bytes that were imported, hashed only if the file was modified
+    return csv_file.exists() and is_prefix_unchanged(csv_file, source)
+
+
+def sync(store: SeriesStore, csv_files: list[Path]) -> int:
+    """
+    Appends the rows added to the csv files since the last sync. The whole store is built again when a csv file
+    changed before the offset it was read up to (or is gone), or a sync stopped while appending the rows of a file.
+    Returns the number of rows appended.
+    """
+    sources = load_sources(store)
+    names = {csv_file.name for csv_file in csv_files}
+    csv_dir = csv_files[0].parent if csv_files else None
+    # "appending": rows of a sync stopped while appending them may be in the store
+    if any(
+        name not in names
+        or source.get("appending")
+        or not is_source_unchanged(csv_dir / name, source)
+        for name, source in sources.items()
+    ):
+        print(f"csv files of {store.base_dir} changed, importing them again")
+        for state_code in store.get_state_codes():
+            shutil.rmtree(store.base_dir / state_code)
+        sources = {}
+    count = 0
+    for csv_file in sorted(csv_files):
+        source = sources.get(csv_file.name, {"offset": 0})
+        stat = get_file_stat(csv_file)
+        _, rows, offset = read_tail(csv_file, source["offset"])
+        if offset == source["offset"]:
+            if source["offset"] and any(
+                source.get(key) != value for key, value in stat.items()
+            ):
+                # modified without new rows (checked out again), its prefix was hashed above
+                sources[csv_file.name] = {**source, **stat}
+                save_sources(store, sources)
+            continue
+        rows = [row for row in rows if row["Datetime"]]
+        rows.sort(key=lambda row: row["Datetime"])
+        sources[csv_file.name] = {**source, "appending": True}
+        save_sources(store, sources)
+        count += store.append(rows)
+        sources[csv_file.name] = {
+            "offset": offset,
+            "prefix_hash": get_prefix_hash(csv_file, offset),
+            **stat,
+        }
+        save_sources(store, sources)
+    return count
+
+
+def import_csv(store: SeriesStore, csv_files: list[Path]):
+    # rebuilds the store from csv files, the csv files have every row the store has
+    for state_code in store.get_state_codes():
+        shutil.rmtree(store.base_dir / state_code)
+    (store.base_dir / "sources.json").unlink(missing_ok=True)
+    count = sync(store, csv_files)
+    print(f"{count} rows imported to {store.base_dir}")
+
+
+def parse_date(value: str, end=False) -> int:
+    # dates are IST, the end of the range includes the whole day
+    date = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=ist)
+    if end:
+        date += timedelta(days=1, seconds=-1)
+    return int(date.timestamp())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Current generation series store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="build a store from raw csv")
+    import_parser.add_argument("store", choices=list(store_metrics))
+    read_parser = subparsers.add_parser("read", help="print the series of a state")
+    read_parser.add_argument("store", choices=list(store_metrics))
+    read_parser.add_argument("state_code")
+    read_parser.add_argument("--start", help="YYYY-MM-DD")
+    read_parser.add_argument("--end", help="YYYY-MM-DD, included")
+    export_parser = subparsers.add_parser("export", help="write a store as csv")
+    export_parser.add_argument("store", choices=list(store_metrics))
+    export_parser.add_argument("output_file", type=Path)
+    parser.add_argument("--series-dir", type=Path, default=series_dir)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    store = get_store(args.store, args.series_dir)
+    if args.command == "import":
+        import_csv(store, get_csv_files(args.store))
+    else:
+        sync(store, get_csv_files(args.store))
+    if args.command == "read":
+        start = parse_date(args.start) if args.start else None
+        end = parse_date(args.end, end=True) if args.end else None
+        timestamps, columns = store.read(args.state_code, start, end)
+        print(",".join(["Datetime", *store.metrics]))
+        for index, timestamp in enumerate(timestamps):
+            values = [format_value(columns[metric][index]) for metric in store.metrics]
+            print(",".join([format_timestamp(timestamp), *values]))
+    elif args.command == "export":
+        export_csv(store, args.output_file)
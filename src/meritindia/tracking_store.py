@@ -0,0 +1,116 @@
+"""
+Tracking data (what was fetched, what failed) kept as a JSON snapshot plus an append-only journal.
+Used by download_reports.py for the NPP track.json and by daily_generation_helper for data/meritindia/track.
+
+* set/delete append one line to <name>.journal.jsonl instead of rewriting the whole JSON file
+* loading replays the journal on top of the snapshot, a torn last line from a crash is cut off the journal,
+  so the next entry is not appended to it
+* compact writes the snapshot atomically (temp file, fsync, rename) and removes the journal.
+  It runs every compact_every changes and on close, so the snapshot keeps the same format as before.
+"""
+
+import json
+import os
+from pathlib import Path
+
+
+class TrackingStore:
+    def __init__(self, path: Path, default: dict = None, compact_every: int = 500):
+        self.path = Path(path)
+        self.journal_path = self.path.with_suffix(".journal.jsonl")
+        self.compact_every = compact_every
+        self.data = self._load_snapshot(default)
+        self.pending = self._replay_journal()
+        self.journal = None
+        if not self.path.exists():
+            self.compact()
+
+    def _load_snapshot(self, default):
+        if not self.path.exists():
+            return json.loads(json.dumps(default or {}))
+        with open(self.path, "r") as file:
+            return json.load(file)
+
+    def _replay_journal(self) -> int:
+        if not self.journal_path.exists():
+            return 0
+        replayed = 0
+        # end of the last complete entry
+        offset = 0
+        with open(self.journal_path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self._apply(entry)
+                replayed += 1
+                offset += len(line)
+        if offset < self.journal_path.stat().st_size:
+            # partially written entry, the process died while appending it
+            with open(self.journal_path, "r+b") as file:
+                file.truncate(offset)
+        return replayed
+
+    def _apply(self, entry: dict):
+        *parents, key = entry["path"]
+        node = self.data
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        if entry["op"] == "set":
+            node[key] = entry["value"]
+        elif entry["op"] == "delete":
+            node.pop(key, None)
+
+    def _append(self, entry: dict):
+        self._apply(entry)
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a")
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+        self.pending += 1
+        if self.pending >= self.compact_every:
+            self.compact()
+
+    def get(self, path: list, default=None):
+        node = self.data
+        for key in path:
+            if not isinstance(node, dict) or key not in node:
+                return default
+            node = node[key]
+        return node
+
+    def set(self, path: list, value):
+        if self.get(path) == value:
+            return
+        self._append({"op": "set", "path": list(path), "value": value})
+
+    def delete(self, path: list):
+        if self.get(path) is None:
+            return
+        self._append({"op": "delete", "path": list(path)})
+
+    def flush(self):
+        # make the journal durable, a cheap fsync of the appended lines
+        if self.journal is not None:
+            os.fsync(self.journal.fileno())
+
+    def compact(self):
+        temp_path = self.path.with_suffix(".tmp")
+        with open(temp_path, "w") as file:
+            json.dump(self.data, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        # replaying the journal again on top of the new snapshot is harmless, entries only set or delete
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        self.journal_path.unlink(missing_ok=True)
+        self.pending = 0
+
+    def close(self):
+        if self.pending > 0 or self.journal_path.exists():
+            self.compact()